@@ -1,61 +1,1381 @@
 import streamlit as st
 import pandas as pd
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, DeleteOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, PyMongoError
 import os
+import io
+import csv
+import re
+import uuid
+import hashlib
+import hmac
+import atexit
+import threading
+import time
+import functools
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from bson import ObjectId, encode as encode_bson
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+
+# Mesures de performance : un écouteur pymongo attribue chaque commande à la
+# réexécution du script en cours (même fil d'exécution) et des minuteurs mesurent
+# les fonctions d'accès aux données. Les mesures restent en mémoire, dans des
+# tampons circulaires bornés partagés par toutes les sessions.
+METRICS_ENABLED = str(st.secrets.get("METRICS_ENABLED", "true")).lower() in ("1", "true", "yes")
+METRICS_BUFFER_SIZE = int(st.secrets.get("METRICS_BUFFER_SIZE", 2000))
+METRICS_PORT = st.secrets.get("METRICS_PORT")
+# Compter les octets oblige à réencoder chaque commande et chaque réponse en BSON
+METRICS_COUNT_BYTES = str(st.secrets.get("METRICS_COUNT_BYTES", "false")).lower() in ("1", "true", "yes")
+BACKGROUND_PAGE = "(arrière-plan)"
+
+@st.cache_resource
+def get_metrics():
+    return {
+        "lock": threading.Lock(),
+        # Mesures propres au fil d'exécution : réexécution en cours, commandes démarrées
+        "local": threading.local(),
+        "reruns": deque(maxlen=METRICS_BUFFER_SIZE),
+        "commands": deque(maxlen=METRICS_BUFFER_SIZE),
+        # Cumuls depuis le démarrage du processus, pour l'export Prometheus
+        "page_totals": {},
+        "command_totals": {},
+        "bytes_totals": {"sent": 0, "received": 0},
+    }
+
+def start_rerun():
+    if METRICS_ENABLED:
+        get_metrics()["local"].rerun = {"start": time.perf_counter(), "ops": 0, "bytes": 0, "spans": [], "commands": []}
+
+def end_rerun(page):
+    """Clôt la mesure de la réexécution en cours ; une réexécution interrompue par une erreur n'est pas gardée."""
+    if not METRICS_ENABLED:
+        return
+    metrics = get_metrics()
+    rerun = getattr(metrics["local"], "rerun", None)
+    if rerun is None:
+        return
+    metrics["local"].rerun = None
+    rerun.update(page=page, ms=(time.perf_counter() - rerun.pop("start")) * 1000)
+    commands = [{**command, "page": page} for command in rerun.pop("commands")]
+    with metrics["lock"]:
+        metrics["reruns"].append(rerun)
+        metrics["commands"].extend(commands)
+        totals = metrics["page_totals"].setdefault(page, {"count": 0, "seconds": 0.0})
+        totals["count"] += 1
+        totals["seconds"] += rerun["ms"] / 1000
+
+def timed(func):
+    """Ajoute la durée de chaque appel de `func` aux mesures de la réexécution en cours."""
+    if not METRICS_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            rerun = getattr(get_metrics()["local"], "rerun", None)
+            if rerun is not None:
+                rerun["spans"].append((func.__name__, (time.perf_counter() - start) * 1000))
+    return wrapper
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Compte commandes, durées et (si METRICS_COUNT_BYTES) octets échangés ; les commandes des fils de fond vont à BACKGROUND_PAGE."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        local = self.metrics["local"]
+        if not hasattr(local, "pending"):
+            local.pending = {}
+        # Le nom de la collection n'est connu qu'au démarrage (getMore le porte dans "collection")
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "")
+        local.pending[event.request_id] = (collection, len(encode_bson(event.command)) if METRICS_COUNT_BYTES else 0)
+
+    def succeeded(self, event):
+        self._record(event, len(encode_bson(event.reply)) if METRICS_COUNT_BYTES else 0, failed=False)
+
+    def failed(self, event):
+        self._record(event, 0, failed=True)
+
+    def _record(self, event, received, failed):
+        local = self.metrics["local"]
+        collection, sent = getattr(local, "pending", {}).pop(event.request_id, ("", 0))
+        command = {
+            "command": event.command_name, "collection": collection, "ms": event.duration_micros / 1000,
+            "bytes": sent + received, "failed": failed,
+        }
+        rerun = getattr(local, "rerun", None)
+        if rerun is not None:
+            rerun["ops"] += 1
+            rerun["bytes"] += sent + received
+            rerun["commands"].append(command)
+        with self.metrics["lock"]:
+            if rerun is None:
+                self.metrics["commands"].append({**command, "page": BACKGROUND_PAGE})
+            totals = self.metrics["command_totals"].setdefault(event.command_name, {"count": 0, "failed": 0, "seconds": 0.0})
+            totals["count"] += 1
+            totals["failed"] += failed
+            totals["seconds"] += event.duration_micros / 1e6
+            self.metrics["bytes_totals"]["sent"] += sent
+            self.metrics["bytes_totals"]["received"] += received
+
+def metrics_snapshot():
+    metrics = get_metrics()
+    with metrics["lock"]:
+        return list(metrics["reruns"]), list(metrics["commands"])
+
+def rerun_stats(reruns):
+    """Latences p50/p95, opérations et octets MongoDB par réexécution, page par page."""
+    df = pd.DataFrame(reruns, columns=["page", "ms", "ops", "bytes"]).astype({"ms": float, "ops": int, "bytes": int})
+    grouped = df.groupby("page")
+    return pd.DataFrame({
+        "Réexécutions": grouped.size(),
+        "p50 (ms)": grouped["ms"].quantile(0.5),
+        "p95 (ms)": grouped["ms"].quantile(0.95),
+        "Opérations MongoDB (moy.)": grouped["ops"].mean(),
+        "Opérations MongoDB (max.)": grouped["ops"].max(),
+        "Octets échangés (moy.)": grouped["bytes"].mean(),
+    }).round(1)
+
+def span_stats(reruns):
+    df = pd.DataFrame([span for rerun in reruns for span in rerun["spans"]], columns=["Fonction", "ms"]).astype({"ms": float})
+    grouped = df.groupby("Fonction")["ms"]
+    return pd.DataFrame({"Appels": grouped.size(), "p50 (ms)": grouped.quantile(0.5), "p95 (ms)": grouped.quantile(0.95)}).round(1)
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_metrics():
+    """Mesures au format texte de Prometheus : quantiles sur le tampon, compteurs cumulés."""
+    reruns, _ = metrics_snapshot()
+    metrics = get_metrics()
+    with metrics["lock"]:
+        page_totals = {page: dict(totals) for page, totals in metrics["page_totals"].items()}
+        command_totals = {name: dict(totals) for name, totals in metrics["command_totals"].items()}
+        bytes_totals = dict(metrics["bytes_totals"])
+    lines = [
+        "# HELP suivi_eps_rerun_seconds Durée des réexécutions du script par page.",
+        "# TYPE suivi_eps_rerun_seconds summary",
+    ]
+    stats = rerun_stats(reruns)
+    for page, totals in sorted(page_totals.items()):
+        label = f'page="{_prometheus_label(page)}"'
+        if page in stats.index:
+            lines.append(f'suivi_eps_rerun_seconds{{{label},quantile="0.5"}} {stats.at[page, "p50 (ms)"] / 1000}')
+            lines.append(f'suivi_eps_rerun_seconds{{{label},quantile="0.95"}} {stats.at[page, "p95 (ms)"] / 1000}')
+        lines.append(f"suivi_eps_rerun_seconds_sum{{{label}}} {totals['seconds']}")
+        lines.append(f"suivi_eps_rerun_seconds_count{{{label}}} {totals['count']}")
+    lines += [
+        "# HELP suivi_eps_mongo_commands_total Commandes MongoDB envoyées, par nom de commande.",
+        "# TYPE suivi_eps_mongo_commands_total counter",
+    ]
+    lines += [f'suivi_eps_mongo_commands_total{{command="{_prometheus_label(name)}"}} {totals["count"]}' for name, totals in sorted(command_totals.items())]
+    lines += [
+        "# HELP suivi_eps_mongo_command_failures_total Commandes MongoDB en échec, par nom de commande.",
+        "# TYPE suivi_eps_mongo_command_failures_total counter",
+    ]
+    lines += [f'suivi_eps_mongo_command_failures_total{{command="{_prometheus_label(name)}"}} {totals["failed"]}' for name, totals in sorted(command_totals.items())]
+    lines += [
+        "# HELP suivi_eps_mongo_command_seconds_total Temps passé dans les commandes MongoDB.",
+        "# TYPE suivi_eps_mongo_command_seconds_total counter",
+    ]
+    lines += [f'suivi_eps_mongo_command_seconds_total{{command="{_prometheus_label(name)}"}} {totals["seconds"]}' for name, totals in sorted(command_totals.items())]
+    if METRICS_COUNT_BYTES:
+        lines += [
+            "# HELP suivi_eps_mongo_bytes_total Octets BSON échangés avec MongoDB.",
+            "# TYPE suivi_eps_mongo_bytes_total counter",
+            f'suivi_eps_mongo_bytes_total{{direction="sent"}} {bytes_totals["sent"]}',
+            f'suivi_eps_mongo_bytes_total{{direction="received"}} {bytes_totals["received"]}',
+        ]
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Sert /metrics au format texte de Prometheus."""
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@st.cache_resource
+def start_metrics_server():
+    server = ThreadingHTTPServer(("0.0.0.0", int(METRICS_PORT)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    atexit.register(server.shutdown)
+    return server
+
+start_rerun()
 
 # Connexion à MongoDB Atlas via st.secrets
+# Un seul client (et donc un seul pool de connexions) par processus serveur,
+# partagé par toutes les sessions et toutes les réexécutions du script.
 MONGO_URI = st.secrets["MONGO_URI"]
-client = MongoClient(MONGO_URI)
-db = client["SuiviEPS"]
+
+@st.cache_resource
+def get_client():
+    client = MongoClient(
+        MONGO_URI,
+        maxPoolSize=int(st.secrets.get("MONGO_MAX_POOL_SIZE", 20)),
+        minPoolSize=int(st.secrets.get("MONGO_MIN_POOL_SIZE", 0)),
+        serverSelectionTimeoutMS=int(st.secrets.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        connectTimeoutMS=int(st.secrets.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        socketTimeoutMS=int(st.secrets.get("MONGO_SOCKET_TIMEOUT_MS", 10000)),
+        maxIdleTimeMS=int(st.secrets.get("MONGO_MAX_IDLE_TIME_MS", 300000)),
+        event_listeners=[MongoCommandListener(get_metrics())] if METRICS_ENABLED else [],
+        connect=False,
+    )
+    atexit.register(client.close)
+    return client
+
+db = get_client()["SuiviEPS"]
+
+# Classes : élèves, Hall of Fame et vidéos portent un "class_id" ; chaque session
+# ne lit que la classe choisie à la connexion.
+DEFAULT_CLASS = st.secrets.get("DEFAULT_CLASS", "Classe principale")
+# Nombre de versions (toutes classes confondues) gardées dans chaque cache de lecture
+CACHE_MAX_ENTRIES = int(st.secrets.get("CACHE_MAX_ENTRIES", 64))
+
+def current_class():
+    return st.session_state.get("class_id")
 
 # Fonctions Hall of Fame
-def load_hof():
+@st.cache_resource
+def ensure_hof_schema():
+    db.hall_of_fame.update_many({"class_id": {"$exists": False}}, {"$set": {"class_id": DEFAULT_CLASS}})
+    db.hall_of_fame.create_index("class_id")
+    return True
+
+@timed
+def load_hof(class_id):
+    ensure_hof_schema()
     collection = db.hall_of_fame
-    data = list(collection.find({}, {"_id": 0}))
+    data = list(collection.find({"class_id": class_id}, {"_id": 0, "class_id": 0}))
     if not data:
         return [{"name": "", "achievement": ""} for _ in range(3)]
     return data
 
-def save_hof(hof_data):
+@timed
+def save_hof(hof_data, class_id):
     collection = db.hall_of_fame
-    collection.delete_many({})
+    collection.delete_many({"class_id": class_id})
     if hof_data:
-        collection.insert_many(hof_data)
+        collection.insert_many([{**entry, "class_id": class_id} for entry in hof_data])
+
+# Versions des données partagées entre les sessions : chaque écriture incrémente
+# la version concernée (par classe), ce qui invalide les caches de lecture qui en dépendent.
+@st.cache_resource
+def _data_versions():
+    return {"lock": threading.Lock(), "counters": {}}
+
+def data_version(name, class_id=None):
+    return _data_versions()["counters"].get((name, class_id), 0)
+
+def bump_version(*names, class_id=None):
+    versions = _data_versions()
+    with versions["lock"]:
+        for name in names:
+            versions["counters"][(name, class_id)] = versions["counters"].get((name, class_id), 0) + 1
 
 # Fonctions gestion des élèves (stocké MongoDB)
-def load_data():
+# Chaque élève porte un identifiant stable "StudentId" qui sert d'index au DataFrame
+# et de clé pour les écritures : seules les lignes modifiées sont envoyées à MongoDB.
+def new_student_id():
+    return uuid.uuid4().hex
+
+@st.cache_resource
+def ensure_students_schema():
     collection = db.students
-    data = list(collection.find({}, {"_id": 0}))
-    if not data:
-        df = pd.DataFrame({
-            "Nom": [],
-            "Niveau": [],
-            "Points de Compétence": [],
-            "Rôles": [],
-            "Pouvoirs": [],
-            "StudentCode": [],
-        })
-    else:
-        df = pd.DataFrame(data)
-        df = df.rename(columns={"Points_de_Competence": "Points de Compétence"})
+    # Migration des anciens documents créés sans identifiant stable
+    legacy = list(collection.find({"StudentId": {"$exists": False}}, {"_id": 1}))
+    if legacy:
+        collection.bulk_write(
+            [UpdateOne({"_id": doc["_id"]}, {"$set": {"StudentId": new_student_id()}}) for doc in legacy],
+            ordered=False,
+        )
+    collection.update_many({"class_id": {"$exists": False}}, {"$set": {"class_id": DEFAULT_CLASS}})
+    # Rôles et pouvoirs : anciennes chaînes séparées par des virgules -> tableaux
+    legacy_items = [
+        doc for doc in collection.find(
+            {"$or": [{field: condition} for field in ITEM_FIELDS for condition in ({"$type": "string"}, None)]},
+            {"_id": 1, **{field: 1 for field in ITEM_FIELDS}},
+        )
+        if not all(isinstance(doc.get(field), list) for field in ITEM_FIELDS)
+    ]
+    if legacy_items:
+        collection.bulk_write(
+            [UpdateOne({"_id": doc["_id"]}, {"$set": {field: split_items(doc.get(field)) for field in ITEM_FIELDS}}) for doc in legacy_items],
+            ordered=False,
+        )
+    collection.create_index("StudentId", unique=True)
+    collection.create_index([("class_id", 1), ("Nom", 1)])
+    collection.create_index([("class_id", 1), ("Points_de_Competence", -1), ("Nom", 1)])
+    return True
+
+# Délai au-delà duquel le roster est relu même sans écriture locale, pour voir
+# les écritures faites par d'autres réplicas du serveur.
+ROSTER_TTL = int(st.secrets.get("ROSTER_CACHE_TTL", 60))
+
+# Champs chargés en mémoire : le code d'accès reste dans MongoDB (voir check_student_code)
+ROSTER_FIELDS = ["StudentId", "Nom", "Niveau", "Points_de_Competence", "Rôles", "Pouvoirs"]
+ROSTER_PROJECTION = {"_id": 0, **{field: 1 for field in ROSTER_FIELDS}}
+
+def split_items(value):
+    """Liste des rôles ou pouvoirs, qu'ils viennent d'un tableau, d'une chaîne jointe ou d'une cellule vide."""
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return []
+    return [item.strip() for item in str(value).split(",") if item.strip()]
+
+def join_items(value):
+    return ", ".join(split_items(value))
+
+def _item_lists(record):
+    """Copie de `record` où les rôles et pouvoirs (chaînes jointes en mémoire) deviennent des tableaux."""
+    return {field: split_items(value) if field in ITEM_FIELDS else value for field, value in record.items()}
+
+def _roster_frame(docs, categorical=True):
+    """Roster typé : entiers sur 32 bits et objets joints en une chaîne, catégorielle si `categorical`."""
+    df = pd.DataFrame(docs, columns=ROSTER_FIELDS).set_index("StudentId")
+    df = df.rename(columns={"Points_de_Competence": "Points de Compétence"})
+    for col in ["Niveau", "Points de Compétence"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int32")
+    for col in ITEM_FIELDS:
+        df[col] = df[col].map(join_items).astype("category" if categorical else object)
     return df
 
-def save_data(df):
-    df_to_save = df.rename(columns={"Points de Compétence": "Points_de_Competence"})
-    collection = db.students
-    collection.delete_many({})
-    records = df_to_save.to_dict(orient="records")
-    if records:
-        collection.insert_many(records)
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+@timed
+def _fetch_students(class_id, version):
+    # Mesuré sous le cache : seuls les chargements depuis MongoDB apparaissent
+    ensure_students_schema()
+    df = _roster_frame(db.students.find({"class_id": class_id}, ROSTER_PROJECTION))
+    # Index nom -> StudentId construit une fois par version, en même temps que le roster
+    by_name = dict(zip(df["Nom"], df.index))
+    return df, by_name
+
+@timed
+def refresh_students():
+    """Roster de la classe (partagé par toutes les sessions : à ne jamais modifier en place) dans la session."""
+    roster, by_name = _fetch_students(current_class(), data_version("students", current_class()))
+    if roster is not st.session_state.get("students_snapshot"):
+        st.session_state["students"] = roster
+        st.session_state["students_snapshot"] = roster
+        st.session_state["students_by_name"] = by_name
+
+def student_id_for(name):
+    return st.session_state["students_by_name"].get(name)
+
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=4, show_spinner=False)
+def _fetch_classes(version):
+    ensure_students_schema()
+    return sorted(db.students.distinct("class_id"))
+
+def load_classes():
+    return _fetch_classes(data_version("classes"))
+
+def get_student(student_id):
+    """Ligne d'un élève par son identifiant (recherche par table de hachage sur l'index)."""
+    return st.session_state["students"].loc[student_id]
+
+def students_with_item(students, field, names):
+    """Masque des élèves possédant l'un des `names` : testé une fois par catégorie, puis propagé par code."""
+    column = students[field]
+    matching = [code for code, value in enumerate(column.cat.categories) if not set(split_items(value)).isdisjoint(names)]
+    return column.cat.codes.isin(matching)
+
+def item_names(students, field):
+    return sorted({item for value in students[field].cat.categories for item in split_items(value)})
+
+def student_has_code(student_id):
+    return db.students.count_documents({"StudentId": student_id, "StudentCode": {"$nin": ["", None]}}, limit=1) > 0
+
+def check_student_code(student_id, code):
+    return db.students.count_documents({"StudentId": student_id, "StudentCode": code}, limit=1) > 0
+
+def set_student_code(student_id, code):
+    # Écrit directement : le code n'est pas dans le roster et doit valoir dès la connexion suivante
+    db.students.update_one({"StudentId": student_id}, {"$set": {"StudentCode": code}})
+
+def diff_students(before, after, class_id):
+    """Écritures (une par élève) qui font passer la classe de `before` à `after`."""
+    writes = [{"StudentId": student_id, "delete": True} for student_id in before.index.difference(after.index)]
+    common = after.index.intersection(before.index)
+    old = before.reindex(index=common, columns=after.columns)
+    new = after.loc[common]
+    unchanged = (old == new) | (old.isna() & new.isna())
+    changed_rows = unchanged.index[~unchanged.all(axis=1)]
+    for student_id in changed_rows:
+        changed_cols = unchanged.columns[~unchanged.loc[student_id]]
+        record = after.loc[[student_id], changed_cols].to_dict(orient="records")[0]
+        writes.append({"StudentId": student_id, "$set": _item_lists(record)})
+    added = after.index.difference(before.index)
+    for student_id, record in after.loc[added].to_dict(orient="index").items():
+        writes.append({"StudentId": student_id, "$set": {**_item_lists(record), "class_id": class_id}, "upsert": True})
+    return writes
+
+def _bulk_ops(writes):
+    ops = []
+    for write in writes:
+        selector = {"StudentId": write["StudentId"]}
+        if write.get("delete"):
+            ops.append(DeleteOne(selector))
+        else:
+            update = {operator: write[operator] for operator in ("$set", "$inc") if write.get(operator)}
+            if write.get("batch"):
+                # Écriture différée : ignorée si son jeton est déjà enregistré (renvoi après une erreur réseau)
+                selector["wb_batches"] = {"$ne": write["batch"]}
+                update["$push"] = {"wb_batches": {"$each": [write["batch"]], "$slice": -WRITE_BEHIND_TOKENS_KEPT}}
+            ops.append(UpdateOne(selector, update, upsert=write.get("upsert", False)))
+    return ops
+
+def write_students(writes, events=()):
+    """Applique les écritures d'élèves, tout de suite ou via la file d'écriture différée."""
+    if WRITE_BEHIND:
+        enqueue_writes(writes, events, current_class())
+        return
+    events = list(events)
+
+    def apply(session):
+        if writes:
+            db.students.bulk_write(_bulk_ops(writes), ordered=False, session=session)
+        record_events(events, session=session)
+
+    in_transaction(apply)
+
+def _as_stored(df):
+    # Colonnes d'objets décatégorisées : deux rosters ne se comparent pas si leurs catégories diffèrent
+    stored = df.rename(columns={"Points de Compétence": "Points_de_Competence"})
+    return stored.astype({field: object for field in ITEM_FIELDS if field in stored.columns})
+
+@timed
+def save_data(df, before=None):
+    """Enregistre les différences entre `df` et `before` (par défaut, le roster chargé par la session)."""
+    if before is None:
+        before = st.session_state["students_snapshot"]
+    before = _as_stored(before)
+    after = _as_stored(df)
+    writes = diff_students(before, after, current_class())
+    if writes:
+        write_students(writes, ledger_events(before, after))
+        if before.reindex(columns=LEADERBOARD_FIELDS).equals(after.reindex(columns=LEADERBOARD_FIELDS)):
+            bump_version("students", class_id=current_class())
+        else:
+            bump_version("students", "leaderboard", class_id=current_class())
+        if not after.index.difference(before.index).empty:
+            bump_version("classes")
+    refresh_students()
     st.write("[INFO] Données sauvegardées.")
 
+# Leaderboard : top-k servi par l'index (class_id, Points_de_Competence, Nom) et mis
+# en cache jusqu'à la prochaine écriture de la classe qui touche un champ affiché.
+LEADERBOARD_FIELDS = ["Nom", "Niveau", "Points_de_Competence", "Rôles", "Pouvoirs"]
+
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _fetch_leaderboard(class_id, version, size):
+    ensure_students_schema()
+    projection = {"_id": 0, **{field: 1 for field in LEADERBOARD_FIELDS}}
+    cursor = db.students.find({"class_id": class_id}, projection).sort([("Points_de_Competence", -1), ("Nom", 1)]).limit(size)
+    return [{**doc, **{field: join_items(doc.get(field)) for field in ITEM_FIELDS}} for doc in cursor]
+
+@timed
+def load_leaderboard(size=10):
+    return _fetch_leaderboard(current_class(), data_version("leaderboard", current_class()), size)
+
+# Journal des événements : chaque attribution, ajustement ou achat est ajouté
+# (insertion seule) dans la collection "events". Les soldes se reconstruisent à
+# partir du dernier instantané ("snapshots") et des événements qui le suivent ;
+# un fil de compaction replie périodiquement les anciens événements en instantanés.
+# Écriture d'élèves et événements partent dans une même transaction quand le
+# déploiement le permet ; la fiche élève compare au besoin la base au journal.
+BALANCE_FIELDS = ["Niveau", "Points_de_Competence"]
+ITEM_FIELDS = ["Rôles", "Pouvoirs"]
+COMPACTION_INTERVAL = int(st.secrets.get("LEDGER_COMPACTION_INTERVAL", 3600))
+# Les événements enregistrés depuis moins que ce délai ne sont pas encore compactés,
+# pour laisser arriver ceux d'autres réplicas. Fenêtres et instantanés suivent la date
+# d'enregistrement ("recorded") : un événement de la file d'écriture différée envoyé
+# en retard garde sa date ("ts") sans être oublié.
+COMPACTION_DELAY = timedelta(seconds=int(st.secrets.get("LEDGER_COMPACTION_DELAY", 600)))
+# Bail d'une compaction : passé ce délai, un autre réplica peut la reprendre
+COMPACTION_LEASE = timedelta(seconds=int(st.secrets.get("LEDGER_COMPACTION_LEASE", 600)))
+
+def utcnow():
+    # MongoDB stocke les dates à la milliseconde : on tronque pour comparer des valeurs identiques
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+@st.cache_resource
+def ensure_ledger_schema():
+    db.events.create_index([("StudentId", 1), ("ts", 1)])
+    db.events.create_index([("StudentId", 1), ("recorded", 1)])
+    db.events.create_index("recorded")
+    db.snapshots.create_index([("StudentId", 1), ("ts", -1)])
+    # Événements antérieurs à la date d'enregistrement : enregistrés à leur date
+    legacy = [UpdateOne({"_id": event["_id"]}, {"$set": {"recorded": event["ts"]}}) for event in db.events.find({"recorded": {"$exists": False}}, {"ts": 1})]
+    if legacy:
+        db.events.bulk_write(legacy, ordered=False)
+    if db.snapshots.estimated_document_count() == 0:
+        # Instantané initial des élèves existant avant la mise en place du journal
+        now = utcnow()
+        fields = {field: 1 for field in BALANCE_FIELDS + ITEM_FIELDS}
+        baseline = [
+            {"StudentId": doc["StudentId"], "ts": now, **{field: doc.get(field) for field in fields}}
+            for doc in db.students.find({}, {"_id": 0, "StudentId": 1, **fields})
+        ]
+        if baseline:
+            db.snapshots.insert_many(baseline, ordered=False)
+    db.ledger_meta.update_one({"_id": "compaction"}, {"$setOnInsert": {"until": utcnow()}}, upsert=True)
+    return True
+
+def record_events(events, session=None):
+    if events:
+        ensure_ledger_schema()
+        recorded = utcnow()
+        db.events.insert_many([{**event, "recorded": recorded} for event in events], ordered=False, session=session)
+
+@st.cache_resource
+def transactions_supported():
+    # Transactions réservées aux jeux de réplicas (Atlas) et aux clusters partitionnés ;
+    # une erreur de connexion est propagée pour ne pas mettre en cache une réponse fausse
+    try:
+        hello = db.command("hello")
+    except NotImplementedError:
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+def in_transaction(action):
+    """Exécute `action(session)` dans une transaction si le déploiement le permet, sinon `action(None)`.
+
+    Une écriture d'élèves et les événements qui la décrivent aboutissent ainsi ensemble.
+    """
+    if not transactions_supported():
+        return action(None)
+    with get_client().start_session() as session:
+        return session.with_transaction(action)
+
+def ledger_events(before, after):
+    """Événements décrivant les changements de soldes et d'objets entre deux rosters."""
+    now = utcnow()
+    events = [{"StudentId": student_id, "type": "suppression", "ts": now} for student_id in before.index.difference(after.index)]
+    common = after.index.intersection(before.index)
+    old = before.reindex(index=common, columns=BALANCE_FIELDS + ITEM_FIELDS)
+    new = after.reindex(index=common, columns=BALANCE_FIELDS + ITEM_FIELDS)
+    deltas = (
+        new[BALANCE_FIELDS].apply(pd.to_numeric, errors="coerce").fillna(0)
+        - old[BALANCE_FIELDS].apply(pd.to_numeric, errors="coerce").fillna(0)
+    )
+    items_changed = ~((old[ITEM_FIELDS] == new[ITEM_FIELDS]) | (old[ITEM_FIELDS].isna() & new[ITEM_FIELDS].isna()))
+    for student_id in common[(deltas != 0).any(axis=1) | items_changed.any(axis=1)]:
+        event = {"StudentId": student_id, "type": "ajustement", "ts": now}
+        event.update({field: int(delta) for field, delta in deltas.loc[student_id].items() if delta})
+        changed_items = items_changed.columns[items_changed.loc[student_id]]
+        if len(changed_items):
+            event["set"] = _item_lists(new.loc[[student_id], changed_items].to_dict(orient="records")[0])
+        events.append(event)
+    added = after.reindex(index=after.index.difference(before.index), columns=BALANCE_FIELDS + ITEM_FIELDS)
+    added[BALANCE_FIELDS] = added[BALANCE_FIELDS].apply(pd.to_numeric, errors="coerce").fillna(0).astype(int)
+    for student_id, record in added.to_dict(orient="index").items():
+        event = {"StudentId": student_id, "type": "creation", "ts": now}
+        event.update({field: record[field] for field in BALANCE_FIELDS})
+        event["set"] = {field: split_items(record[field]) for field in ITEM_FIELDS}
+        events.append(event)
+    return events
+
+def fold_events(state, events):
+    """Applique une suite d'événements (triés par date) à un état de soldes."""
+    for event in events:
+        if event.get("type") == "suppression":
+            state.clear()
+            state.update({field: 0 for field in BALANCE_FIELDS})
+            state.update({field: [] for field in ITEM_FIELDS})
+            continue
+        for field in BALANCE_FIELDS:
+            state[field] = (state.get(field) or 0) + event.get(field, 0)
+        state.update({field: split_items(value) for field, value in event.get("set", {}).items()})
+        if "item" in event:
+            state[event["items_field"]] = split_items(state.get(event["items_field"])) + [event["item"]]
+    return state
+
+def _latest_snapshot_state(student_id, until=None):
+    query = {"StudentId": student_id}
+    if until is not None:
+        query["ts"] = {"$lte": until}
+    snapshot = db.snapshots.find_one(query, {"_id": 0}, sort=[("ts", -1)])
+    if snapshot is None:
+        return None, {}
+    state = {field: snapshot.get(field) for field in BALANCE_FIELDS}
+    state.update({field: split_items(snapshot.get(field)) for field in ITEM_FIELDS})
+    return snapshot["ts"], state
+
+def rebuild_balances(student_id):
+    """Soldes d'un élève reconstruits depuis son dernier instantané et les événements suivants."""
+    ensure_ledger_schema()
+    snapshot_ts, state = _latest_snapshot_state(student_id)
+    query = {"StudentId": student_id}
+    if snapshot_ts is not None:
+        query["recorded"] = {"$gt": snapshot_ts}
+    return fold_events(state, db.events.find(query, {"_id": 0}).sort("ts", 1))
+
+def ledger_drift(student_id):
+    """Écarts entre la fiche de l'élève en base et ses soldes reconstruits par le journal.
+
+    Renvoie None si les écritures en attente de l'élève n'ont pas pu être envoyées.
+    """
+    try:
+        if not flush_student(student_id):
+            return None
+    except PyMongoError:
+        return None
+    document = db.students.find_one({"StudentId": student_id}, {"_id": 0, **{field: 1 for field in BALANCE_FIELDS + ITEM_FIELDS}}) or {}
+    ledger = rebuild_balances(student_id)
+    drift = {}
+    for field in BALANCE_FIELDS:
+        delta = (document.get(field) or 0) - (ledger.get(field) or 0)
+        if delta:
+            drift[field] = delta
+    changed_items = {field: split_items(document.get(field)) for field in ITEM_FIELDS if split_items(document.get(field)) != split_items(ledger.get(field))}
+    if changed_items:
+        drift["set"] = changed_items
+    return drift
+
+def reconcile_student(student_id, drift):
+    """Enregistre un événement qui aligne le journal sur la fiche de l'élève."""
+    record_events([{"StudentId": student_id, "type": "reconciliation", "ts": utcnow(), **drift}])
+
+def load_history(student_id, limit=50):
+    ensure_ledger_schema()
+    return list(db.events.find({"StudentId": student_id}, {"_id": 0, "StudentId": 0, "recorded": 0}).sort("ts", -1).limit(limit))
+
+def load_gains(student_ids, since):
+    """Niveaux et points gagnés par ces élèves depuis `since` (les achats sont exclus)."""
+    ensure_ledger_schema()
+    return list(db.events.aggregate([
+        {"$match": {"StudentId": {"$in": list(student_ids)}, "ts": {"$gte": since}, "type": {"$in": ["niveaux", "creation", "ajustement"]}}},
+        {"$group": {"_id": "$StudentId", **{field: {"$sum": f"${field}"} for field in BALANCE_FIELDS}}},
+        {"$sort": {"Points_de_Competence": -1}},
+    ]))
+
+def compact_ledger():
+    """Replie les événements sortis de la fenêtre de compaction dans de nouveaux instantanés.
+
+    Le repère "until" n'avance qu'avec les instantanés : une compaction interrompue
+    laisse la plage à la suivante. Ses instantanés déjà écrits sont sans effet, car
+    chaque compaction part de l'état à "until".
+    """
+    ensure_ledger_schema()
+    now = utcnow()
+    cutoff = now - COMPACTION_DELAY
+    lease = ObjectId()
+    # Bail exclusif pour qu'un autre réplica ne compacte pas en même temps
+    meta = db.ledger_meta.find_one_and_update(
+        {"_id": "compaction", "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"lease": lease, "lease_until": now + COMPACTION_LEASE}},
+    )
+    if meta is None:
+        return 0
+    until = meta["until"]
+    events_by_student = {}
+    for event in db.events.find({"recorded": {"$gt": until, "$lte": cutoff}}, {"_id": 0}).sort("ts", 1):
+        events_by_student.setdefault(event["StudentId"], []).append(event)
+    snapshots = []
+    for student_id, events in events_by_student.items():
+        _, state = _latest_snapshot_state(student_id, until=until)
+        snapshots.append({"StudentId": student_id, "ts": cutoff, **fold_events(state, events)})
+
+    def commit(session):
+        if snapshots:
+            db.snapshots.insert_many(snapshots, ordered=False, session=session)
+        db.ledger_meta.update_one(
+            {"_id": "compaction", "lease": lease},
+            {"$set": {"until": cutoff}, "$unset": {"lease": "", "lease_until": ""}},
+            session=session,
+        )
+
+    in_transaction(commit)
+    return len(snapshots)
+
+@st.cache_resource
+def start_ledger_compaction():
+    def run():
+        while True:
+            time.sleep(COMPACTION_INTERVAL)
+            try:
+                compact_ledger()
+            except Exception as exc:
+                print(f"[WARN] Compaction du journal impossible : {exc}")
+
+    thread = threading.Thread(target=run, name="ledger-compaction", daemon=True)
+    thread.start()
+    return thread
+
+# Opérations atomiques côté serveur : un seul aller-retour par action et aucune
+# écriture concurrente écrasée (ex. un achat pendant une attribution de niveaux).
+@timed
+def grant_levels(student_ids, levels):
+    student_ids = list(student_ids)
+    if student_ids:
+        increment = {"Niveau": levels, "Points_de_Competence": levels * 5}
+        now = utcnow()
+        events = [{"StudentId": student_id, "type": "niveaux", "ts": now, **increment} for student_id in student_ids]
+        if WRITE_BEHIND:
+            enqueue_writes([{"StudentId": student_id, "$inc": increment} for student_id in student_ids], events, current_class())
+        else:
+            def apply(session):
+                db.students.update_many({"StudentId": {"$in": student_ids}}, {"$inc": increment}, session=session)
+                record_events(events, session=session)
+
+            in_transaction(apply)
+        bump_version("students", "leaderboard", class_id=current_class())
+    refresh_students()
+
+@timed
+def purchase(student_id, balance_field, cost, items_field, item):
+    """Débite `cost` et ajoute `item` au tableau `items_field`, si le solde suffit.
+
+    Renvoie "ok", "insuffisant", ou "indisponible" si MongoDB n'a pas pu être joint.
+    """
+    event = {
+        "StudentId": student_id, "type": "achat", "ts": utcnow(),
+        balance_field: -cost, "items_field": items_field, "item": item,
+    }
+
+    def debit(session):
+        updated = db.students.find_one_and_update(
+            {"StudentId": student_id, balance_field: {"$gte": cost}},
+            {"$inc": {balance_field: -cost}, "$push": {items_field: item}},
+            projection={"_id": 1},
+            session=session,
+        )
+        if updated is not None and not WRITE_BEHIND:
+            record_events([dict(event)], session=session)
+        return updated
+
+    try:
+        # Le solde est vérifié par MongoDB : les écritures de cet élève encore en file doivent y être
+        if not flush_student(student_id):
+            return "indisponible"
+        updated = in_transaction(debit)
+    except PyMongoError as exc:
+        print(f"[WARN] Achat impossible : {exc}")
+        return "indisponible"
+    if updated is None:
+        return "insuffisant"
+    if WRITE_BEHIND:
+        enqueue_writes([], [event], current_class())
+    bump_version("students", "leaderboard", class_id=current_class())
+    refresh_students()
+    return "ok"
+
+# File d'écriture différée (optionnelle, secret WRITE_BEHIND) : les écritures
+# d'élèves sont mises en file pour tout le processus, fusionnées par élève, puis
+# envoyées en bulk_write par un fil de fond, à intervalle court ou dès que le lot
+# est plein. Le clic n'attend donc plus l'aller-retour vers Atlas.
+WRITE_BEHIND = str(st.secrets.get("WRITE_BEHIND", "false")).lower() in ("1", "true", "yes")
+WRITE_BEHIND_INTERVAL = float(st.secrets.get("WRITE_BEHIND_INTERVAL", 0.5))
+WRITE_BEHIND_BATCH_SIZE = int(st.secrets.get("WRITE_BEHIND_BATCH_SIZE", 200))
+WRITE_BEHIND_MAX_RETRIES = int(st.secrets.get("WRITE_BEHIND_MAX_RETRIES", 5))
+# Attente maximale d'un achat dont l'élève fait partie du lot en cours d'envoi
+WRITE_BEHIND_WAIT = float(st.secrets.get("WRITE_BEHIND_WAIT", 2))
+# Jetons de lots gardés par élève (wb_batches) : un lot n'est renvoyé qu'avant le suivant
+WRITE_BEHIND_TOKENS_KEPT = 10
+
+@st.cache_resource
+def get_write_queue():
+    queue = {
+        "lock": threading.Lock(),
+        "flush_lock": threading.Lock(),
+        "wake": threading.Event(),
+        "writes": {},
+        "events": [],
+        # Événements (par _id) qui décrivent l'écriture en attente d'un élève : écartés si elle est rejetée
+        "event_owners": {},
+        # Classes touchées par les écritures en attente, dont les caches seront invalidés
+        "classes": set(),
+        # Lot dont l'envoi a échoué : renvoyé avant toute nouvelle écriture pour garder l'ordre
+        "retry": None,
+    }
+
+    def run():
+        while True:
+            queue["wake"].wait(WRITE_BEHIND_INTERVAL)
+            queue["wake"].clear()
+            try:
+                flush_writes()
+            except Exception as exc:
+                print(f"[WARN] Écritures différées non envoyées : {exc}")
+
+    threading.Thread(target=run, name="write-behind", daemon=True).start()
+    atexit.register(flush_writes)
+    return queue
+
+def _merge_write(pending, write):
+    """Fusionne `write` dans l'écriture déjà en attente pour le même élève."""
+    student_id = write["StudentId"]
+    current = pending.get(student_id)
+    if current is None or write.get("delete"):
+        pending[student_id] = {key: dict(value) if isinstance(value, dict) else value for key, value in write.items()}
+        return
+    if current.get("delete"):
+        if write.get("upsert"):
+            pending[student_id] = {key: dict(value) if isinstance(value, dict) else value for key, value in write.items()}
+        return
+    for field, value in write.get("$set", {}).items():
+        current.setdefault("$set", {})[field] = value
+        current.get("$inc", {}).pop(field, None)
+    for field, delta in write.get("$inc", {}).items():
+        if field in current.get("$set", {}):
+            current["$set"][field] += delta
+        else:
+            increments = current.setdefault("$inc", {})
+            increments[field] = increments.get(field, 0) + delta
+    current["upsert"] = current.get("upsert", False) or write.get("upsert", False)
+
+def enqueue_writes(writes, events, class_id):
+    queue = get_write_queue()
+    with queue["lock"]:
+        queue["classes"].add(class_id)
+        for write in writes:
+            _merge_write(queue["writes"], write)
+        written = {write["StudentId"] for write in writes}
+        for event in events:
+            # _id attribué ici pour que le renvoi d'un lot d'événements reste idempotent
+            event = {"_id": ObjectId(), **event}
+            queue["events"].append(event)
+            if event["StudentId"] in written:
+                queue["event_owners"].setdefault(event["StudentId"], []).append(event["_id"])
+        full = len(queue["writes"]) + len(queue["events"]) >= WRITE_BEHIND_BATCH_SIZE
+    if full:
+        queue["wake"].set()
+
+def pending_writes():
+    queue = get_write_queue()
+    with queue["lock"]:
+        retry = queue["retry"]
+        count = len(queue["writes"]) + len(queue["events"])
+    if retry:
+        count += len(retry["writes"]) + len(retry["events"])
+    return count
+
+def _with_retries(action, attempts=None):
+    # Sans risque même si l'envoi précédent a abouti : jetons de lots et _id d'événements
+    attempts = attempts or WRITE_BEHIND_MAX_RETRIES
+    delay = WRITE_BEHIND_INTERVAL
+    for attempt in range(attempts):
+        try:
+            return action()
+        except BulkWriteError:
+            # Erreur sur certains documents : les renvoyer ne la corrigerait pas
+            raise
+        except PyMongoError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+def _insert_events(events):
+    try:
+        # Date d'enregistrement fixée à l'envoi : un renvoi n'insère que les événements manquants
+        recorded = utcnow()
+        db.events.insert_many([{**event, "recorded": recorded} for event in events], ordered=False)
+    except BulkWriteError as exc:
+        # Événements déjà insérés lors d'une tentative précédente
+        if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+            raise
+
+def _drop_owned_events(events, owners, student_ids):
+    """Événements privés de ceux qui décrivent des écritures rejetées."""
+    dropped = {event_id for student_id in student_ids for event_id in owners.get(student_id, [])}
+    if dropped:
+        print(f"[WARN] {len(dropped)} événement(s) d'écritures rejetées écarté(s) du journal")
+    return [event for event in events if event["_id"] not in dropped]
+
+def _send_batch(batch, attempts=None):
+    """Envoie les écritures puis les événements d'un lot, retirés du lot une fois envoyés.
+
+    Chaque écriture reçoit un jeton à son premier envoi et le garde : un lot renvoyé
+    après une erreur (peut-être déjà appliqué) ne réapplique pas ses $inc.
+    """
+    if batch["writes"]:
+        writes = list(batch["writes"].values())
+        for write in writes:
+            write.setdefault("batch", str(ObjectId()))
+        try:
+            _with_retries(lambda: db.students.bulk_write(_bulk_ops(writes), ordered=False), attempts)
+        except BulkWriteError as exc:
+            # Création déjà appliquée : le jeton écarte l'élève existant et l'index unique refuse le doublon
+            errors = [
+                error for error in exc.details["writeErrors"]
+                if not (error["code"] == 11000 and writes[error["index"]].get("upsert"))
+            ]
+            if errors:
+                print(f"[WARN] Écritures différées rejetées : {errors}")
+            rejected = {writes[error["index"]]["StudentId"] for error in errors}
+            batch["events"] = _drop_owned_events(batch["events"], batch["event_owners"], rejected)
+        batch["writes"] = {}
+        for class_id in batch["classes"]:
+            bump_version("students", "leaderboard", class_id=class_id)
+    if batch["events"]:
+        ensure_ledger_schema()
+        _with_retries(lambda: _insert_events(batch["events"]), attempts)
+        batch["events"] = []
+
+def flush_student(student_id):
+    """Envoie tout de suite l'écriture et les événements en attente d'un seul élève.
+
+    Renvoie False si le lot en cours d'envoi ne rend pas la main à temps ou si un lot
+    en échec contient l'élève. En cas d'erreur de MongoDB, l'écriture est renvoyée
+    telle quelle, avec son jeton, au prochain envoi, et l'erreur est propagée.
+    """
+    if not WRITE_BEHIND:
+        return True
+    queue = get_write_queue()
+    # Pas d'envoi concurrent : le lot du fil de fond peut contenir une écriture plus ancienne de l'élève
+    if not queue["flush_lock"].acquire(timeout=WRITE_BEHIND_WAIT):
+        return False
+    try:
+        with queue["lock"]:
+            retry = queue["retry"]
+            if retry is not None and (
+                student_id in retry["writes"] or any(event["StudentId"] == student_id for event in retry["events"])
+            ):
+                return False
+            write = queue["writes"].pop(student_id, None)
+            owned = queue["event_owners"].pop(student_id, [])
+            # Les événements de l'élève partent avec son écriture : le journal reste aligné
+            # sur sa fiche, et ceux de l'écriture sont écartés si elle est rejetée
+            events = [event for event in queue["events"] if event["StudentId"] == student_id]
+            queue["events"] = [event for event in queue["events"] if event["StudentId"] != student_id]
+        if write is None and not events:
+            return True
+        batch = {"writes": {student_id: write} if write is not None else {}, "events": events, "event_owners": {student_id: owned}, "classes": {current_class()}}
+        try:
+            _send_batch(batch, attempts=1)
+        except PyMongoError:
+            with queue["lock"]:
+                retry = queue["retry"]
+                if retry is None:
+                    queue["retry"] = batch
+                else:
+                    retry["writes"].update(batch["writes"])
+                    retry["events"] += batch["events"]
+                    retry["event_owners"].update(batch["event_owners"])
+                    retry["classes"] |= batch["classes"]
+            raise
+        return True
+    finally:
+        queue["flush_lock"].release()
+
+def flush_writes():
+    """Envoie les écritures en attente ; sans effet hors du mode différé."""
+    if not WRITE_BEHIND:
+        return
+    queue = get_write_queue()
+    with queue["flush_lock"]:
+        with queue["lock"]:
+            batch = queue["retry"] or {
+                "writes": queue["writes"], "events": queue["events"],
+                "event_owners": queue["event_owners"], "classes": queue["classes"],
+            }
+            if queue["retry"] is None:
+                queue["writes"], queue["events"], queue["event_owners"], queue["classes"] = {}, [], {}, set()
+            queue["retry"] = batch
+        _send_batch(batch)
+        with queue["lock"]:
+            queue["retry"] = None
+
+# Export et import du roster
+# L'export CSV est produit à la demande en parcourant un curseur par lots, puis
+# mis en cache jusqu'à la prochaine écriture ; l'import valide le fichier en bloc
+# et insère les élèves par paquets.
+EXPORT_COLUMNS = {"Nom": "Nom", "Niveau": "Niveau", "Points_de_Competence": "Points de Compétence", "Rôles": "Rôles", "Pouvoirs": "Pouvoirs"}
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 200
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _export_students_csv(class_id, version):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS.values())
+    cursor = db.students.find({"class_id": class_id}, {"_id": 0, **{field: 1 for field in EXPORT_COLUMNS}}).batch_size(EXPORT_BATCH_SIZE)
+    for doc in cursor:
+        writer.writerow([join_items(doc.get(field)) if field in ITEM_FIELDS else doc.get(field, "") for field in EXPORT_COLUMNS])
+    return buffer.getvalue()
+
+def export_students_csv():
+    return _export_students_csv(current_class(), data_version("students", current_class()))
+
+def read_roster_file(uploaded_file):
+    if uploaded_file.name.lower().endswith(".xlsx"):
+        return pd.read_excel(uploaded_file, engine="openpyxl")
+    return pd.read_csv(uploaded_file, sep=None, engine="python")
+
+def _numeric_column(raw, column, default):
+    """Colonne numérique : cellule vide -> `default`, valeur non numérique -> NaN (rejetée)."""
+    if column not in raw.columns:
+        return default
+    values = pd.to_numeric(raw[column], errors="coerce")
+    blank = raw[column].isna() | (raw[column].astype(str).str.strip() == "")
+    return values.mask(blank, default)
+
+def validate_roster(raw, existing_names):
+    """Sépare les lignes importables des lignes rejetées (avec le motif du rejet)."""
+    raw = raw.rename(columns=lambda col: str(col).strip()).rename(columns={"Points_de_Competence": "Points de Compétence"})
+    if "Nom" not in raw.columns:
+        raise ValueError("Le fichier doit contenir une colonne « Nom ».")
+    df = pd.DataFrame({"Nom": raw["Nom"].astype("string").str.strip()})
+    df["Niveau"] = _numeric_column(raw, "Niveau", 0)
+    df["Points de Compétence"] = _numeric_column(raw, "Points de Compétence", df["Niveau"] * 5)
+    df["Rôles"] = raw["Rôles"].fillna("Apprenti(e)").astype(str) if "Rôles" in raw.columns else "Apprenti(e)"
+    df["Pouvoirs"] = raw["Pouvoirs"].fillna("").astype(str) if "Pouvoirs" in raw.columns else ""
+
+    reasons = pd.Series("", index=df.index)
+    reasons = reasons.mask(df["Nom"].isna() | (df["Nom"] == ""), "nom manquant")
+    reasons = reasons.mask((reasons == "") & df["Nom"].isin(existing_names), "élève déjà inscrit")
+    reasons = reasons.mask((reasons == "") & df["Nom"].duplicated(), "nom en double dans le fichier")
+    numbers = df[["Niveau", "Points de Compétence"]]
+    reasons = reasons.mask((reasons == "") & (numbers.isna() | (numbers < 0) | (numbers % 1 != 0)).any(axis=1), "niveau ou points invalides")
+
+    valid = df[reasons == ""].copy()
+    valid[["Niveau", "Points de Compétence"]] = valid[["Niveau", "Points de Compétence"]].astype(int)
+    rejected = raw[reasons != ""].assign(Motif=reasons[reasons != ""])
+    return valid, rejected
+
+def import_students(valid, on_progress=None):
+    """Insère les élèves validés par paquets de IMPORT_BATCH_SIZE ; renvoie le nombre inséré."""
+    inserted = 0
+    for start in range(0, len(valid), IMPORT_BATCH_SIZE):
+        chunk = valid.iloc[start:start + IMPORT_BATCH_SIZE].rename(columns={"Points de Compétence": "Points_de_Competence"})
+        chunk = chunk.assign(StudentId=[new_student_id() for _ in range(len(chunk))], class_id=current_class())
+        records = [_item_lists(record) for record in chunk.to_dict(orient="records")]
+        now = utcnow()
+        events = [
+            {
+                "StudentId": record["StudentId"], "type": "creation", "ts": now,
+                **{field: record[field] for field in BALANCE_FIELDS},
+                "set": {field: record[field] for field in ITEM_FIELDS},
+            }
+            for record in records
+        ]
+
+        def apply(session):
+            db.students.insert_many([dict(record) for record in records], ordered=False, session=session)
+            record_events([dict(event) for event in events], session=session)
+
+        in_transaction(apply)
+        inserted += len(records)
+        if on_progress:
+            on_progress(inserted, len(valid))
+    if inserted:
+        bump_version("students", "leaderboard", class_id=current_class())
+        bump_version("classes")
+        refresh_students()
+    return inserted
+
+# Tableau de progression paginé : recherche, filtre de niveaux et pagination sont
+# faits par MongoDB ; seules les lignes modifiées dans l'éditeur sont enregistrées.
+PAGE_SIZES = [25, 50, 100]
+NEW_STUDENT_DEFAULTS = {"Niveau": 0, "Rôles": "Apprenti(e)", "Pouvoirs": ""}
+NUMERIC_COLUMNS = ["Niveau", "Points de Compétence"]
+
+def _progress_query(class_id, search, level_min, level_max):
+    query = {"class_id": class_id}
+    if search:
+        query["Nom"] = {"$regex": re.escape(search), "$options": "i"}
+    levels = {}
+    if level_min is not None:
+        levels["$gte"] = level_min
+    if level_max is not None:
+        levels["$lte"] = level_max
+    if levels:
+        query["Niveau"] = levels
+    return query
+
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _count_progress_rows(class_id, version, search, level_min, level_max):
+    ensure_students_schema()
+    return db.students.count_documents(_progress_query(class_id, search, level_min, level_max))
+
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _fetch_progress_page(class_id, version, search, level_min, level_max, page, page_size):
+    ensure_students_schema()
+    query = _progress_query(class_id, search, level_min, level_max)
+    cursor = db.students.find(query, ROSTER_PROJECTION).sort("Nom", 1).skip((page - 1) * page_size).limit(page_size)
+    # Colonnes d'objets en texte libre : l'éditeur limiterait une colonne catégorielle aux valeurs existantes
+    return _roster_frame(cursor, categorical=False)
+
+@timed
+def count_progress_rows(search, level_min, level_max):
+    """Nombre d'élèves de la classe correspondant aux filtres du tableau de progression."""
+    return _count_progress_rows(current_class(), data_version("students", current_class()), search, level_min, level_max)
+
+@timed
+def load_progress_page(search, level_min, level_max, page, page_size):
+    """Page du tableau de progression de la classe."""
+    return _fetch_progress_page(current_class(), data_version("students", current_class()), search, level_min, level_max, page, page_size)
+
+def current_students(student_ids):
+    """Lignes actuellement en base (sans passer par le cache), pour détecter les modifications concurrentes."""
+    return _roster_frame(db.students.find({"StudentId": {"$in": list(student_ids)}}, ROSTER_PROJECTION), categorical=False)
+
+def editor_conflicts(before, after, current):
+    """StudentId des élèves modifiés ou supprimés dans l'éditeur dont un champ concerné a changé en base depuis `before`."""
+    before, after, current = _as_stored(before), _as_stored(after), _as_stored(current)
+    conflicts = []
+    for write in diff_students(before, after, current_class()):
+        student_id = write["StudentId"]
+        if write.get("upsert"):
+            continue
+        if student_id not in current.index:
+            conflicts.append(student_id)
+            continue
+        fields = list(before.columns) if write.get("delete") else list(write["$set"])
+        old, new = before.loc[student_id, fields], current.loc[student_id, fields]
+        if not ((old == new) | (old.isna() & new.isna())).all():
+            conflicts.append(student_id)
+    return conflicts
+
+def apply_editor_changes(page_df, changes):
+    """Page après application des lignes modifiées, ajoutées et supprimées dans st.data_editor.
+
+    Lève ValueError si un niveau ou des points sont vides, négatifs ou non entiers.
+    """
+    after = page_df.astype({column: object for column in NUMERIC_COLUMNS})
+    for position, values in changes.get("edited_rows", {}).items():
+        for column, value in values.items():
+            after.at[page_df.index[int(position)], column] = value
+    after = after.drop(index=page_df.index[list(changes.get("deleted_rows", []))])
+    added_rows = [row for row in changes.get("added_rows", []) if str(row.get("Nom") or "").strip()]
+    if added_rows:
+        added = pd.DataFrame(
+            [{**NEW_STUDENT_DEFAULTS, **{k: v for k, v in row.items() if v is not None}} for row in added_rows],
+            index=pd.Index([new_student_id() for _ in added_rows], name="StudentId"),
+        ).reindex(columns=after.columns)
+        # Comme le formulaire « Ajouter Élève » : 5 points par niveau si rien n'est saisi
+        points = added["Points de Compétence"]
+        added["Points de Compétence"] = points.where(points.notna(), pd.to_numeric(added["Niveau"], errors="coerce") * 5)
+        after = pd.concat([after, added])
+    numbers = after[NUMERIC_COLUMNS].apply(pd.to_numeric, errors="coerce")
+    invalid = (numbers.isna() | (numbers < 0) | (numbers % 1 != 0)).any(axis=1)
+    if invalid.any():
+        raise ValueError(
+            "Niveau et points doivent être des entiers positifs ou nuls : "
+            + ", ".join(after.loc[invalid, "Nom"].astype(str))
+        )
+    after[NUMERIC_COLUMNS] = numbers.astype("int32")
+    return after
+
+# Vidéos stockées par morceaux dans GridFS (bucket "videos") : partagées entre
+# réplicas, conservées aux redémarrages et écrites une seule fois grâce à leur
+# empreinte SHA-256. Une même vidéo peut être proposée à plusieurs classes.
+LEGACY_VIDEO_FILENAME = "uploaded_video.mp4"
+VIDEO_CHUNK_SIZE = 1024 * 1024
+# Lecture en continu (optionnelle) : si VIDEO_STREAM_BASE_URL donne l'adresse publique
+# du serveur, par exemple un chemin du proxy HTTPS qui renvoie vers VIDEO_STREAM_PORT,
+# un petit serveur HTTP sert les morceaux GridFS à la demande. Sans elle, la vidéo
+# est lue en mémoire par Streamlit. Les URL sont signées et expirent : seules celles
+# remises à un membre de la classe marchent.
+VIDEO_STREAM_BASE_URL = str(st.secrets.get("VIDEO_STREAM_BASE_URL", "")).rstrip("/")
+VIDEO_STREAM_PORT = int(st.secrets.get("VIDEO_STREAM_PORT", 8502))
+VIDEO_STREAM_HOST = st.secrets.get("VIDEO_STREAM_HOST", "0.0.0.0")
+VIDEO_URL_TTL = int(st.secrets.get("VIDEO_URL_TTL", 3600))
+
+@st.cache_resource
+def get_video_bucket():
+    db["videos.files"].create_index("metadata.sha256")
+    db["videos.files"].create_index([("metadata.class_ids", 1), ("uploadDate", -1)])
+    db["videos.files"].update_many({"metadata.class_ids": {"$exists": False}}, {"$set": {"metadata.class_ids": [DEFAULT_CLASS]}})
+    bucket = GridFSBucket(db, bucket_name="videos", chunk_size_bytes=VIDEO_CHUNK_SIZE)
+    # Reprise de l'ancienne vidéo stockée sur le disque du conteneur
+    if os.path.exists(LEGACY_VIDEO_FILENAME) and db["videos.files"].estimated_document_count() == 0:
+        with open(LEGACY_VIDEO_FILENAME, "rb") as f:
+            store_video(bucket, LEGACY_VIDEO_FILENAME, f, DEFAULT_CLASS)
+    return bucket
+
+def store_video(bucket, filename, source, class_id):
+    """Enregistre la vidéo pour la classe, sans la réécrire si elle existe déjà ; renvoie (file_id, créée)."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: source.read(VIDEO_CHUNK_SIZE), b""):
+        digest.update(block)
+    existing = db["videos.files"].find_one_and_update(
+        {"metadata.sha256": digest.hexdigest()},
+        {"$addToSet": {"metadata.class_ids": class_id}},
+        projection={"_id": 1},
+    )
+    if existing:
+        bump_version("videos", class_id=class_id)
+        return existing["_id"], False
+    source.seek(0)
+    file_id = bucket.upload_from_stream(
+        filename, source,
+        metadata={"sha256": digest.hexdigest(), "contentType": "video/mp4", "class_ids": [class_id]},
+    )
+    bump_version("videos", class_id=class_id)
+    return file_id, True
+
+def delete_video(file_id, class_id):
+    """Retire la vidéo de la classe ; le fichier est supprimé quand plus aucune classe ne l'utilise."""
+    remaining = db["videos.files"].find_one_and_update(
+        {"_id": ObjectId(file_id)},
+        {"$pull": {"metadata.class_ids": class_id}},
+        projection={"metadata.class_ids": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if remaining is not None and not remaining["metadata"]["class_ids"]:
+        get_video_bucket().delete(ObjectId(file_id))
+    bump_version("videos", class_id=class_id)
+
+@st.cache_resource(ttl=ROSTER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _fetch_videos(class_id, version):
+    get_video_bucket()
+    return list(
+        db["videos.files"].find({"metadata.class_ids": class_id}, {"filename": 1, "length": 1, "uploadDate": 1}).sort("uploadDate", -1)
+    )
+
+def load_videos():
+    return _fetch_videos(current_class(), data_version("videos", current_class()))
+
+@st.cache_resource(max_entries=int(st.secrets.get("VIDEO_MEMORY_CACHE_ENTRIES", 2)), show_spinner=False)
+def read_video(file_id):
+    # Sans serveur de streaming, la vidéo est lue une fois par processus et servie
+    # par Streamlit (qui gère lui-même les requêtes HTTP Range)
+    return get_video_bucket().open_download_stream(ObjectId(file_id)).read()
+
+@st.cache_resource
+def _video_url_key():
+    # Secret partagé entre réplicas si fourni ; sinon clé propre au processus
+    secret = st.secrets.get("VIDEO_URL_SECRET")
+    return secret.encode("utf-8") if secret else os.urandom(32)
+
+def _video_signature(file_id, expires):
+    return hmac.new(_video_url_key(), f"{file_id}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+def signed_video_path(file_id):
+    """Chemin signé valable au moins VIDEO_URL_TTL secondes.
+
+    L'échéance est arrondie à la période : l'URL ne change pas d'une réexécution à
+    l'autre et le lecteur ne recharge pas la vidéo.
+    """
+    expires = (int(time.time()) // VIDEO_URL_TTL + 2) * VIDEO_URL_TTL
+    return f"/videos/{file_id}?expires={expires}&sig={_video_signature(file_id, expires)}"
+
+def _valid_video_request(file_id, query):
+    try:
+        expires = int(query.get("expires", ["0"])[0])
+    except ValueError:
+        return False
+    signature = query.get("sig", [""])[0]
+    return expires >= time.time() and hmac.compare_digest(signature, _video_signature(file_id, expires))
+
+class VideoStreamHandler(BaseHTTPRequestHandler):
+    """Sert /videos/<id> (URL signée) depuis GridFS, morceau par morceau, avec prise en charge des Range."""
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        url = urlsplit(self.path)
+        file_id = url.path.rstrip("/").rsplit("/", 1)[-1]
+        if not url.path.startswith("/videos/") or not ObjectId.is_valid(file_id):
+            self.send_error(404)
+            return
+        if not _valid_video_request(file_id, parse_qs(url.query)):
+            self.send_error(403)
+            return
+        try:
+            grid_out = get_video_bucket().open_download_stream(ObjectId(file_id))
+        except NoFile:
+            self.send_error(404)
+            return
+        size = grid_out.length
+        start, end = 0, size - 1
+        byte_range = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if byte_range and (byte_range.group(1) or byte_range.group(2)):
+            if byte_range.group(1):
+                start = int(byte_range.group(1))
+                end = min(int(byte_range.group(2)), size - 1) if byte_range.group(2) else size - 1
+            else:
+                start = max(size - int(byte_range.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = grid_out.read(min(VIDEO_CHUNK_SIZE, remaining))
+            if not block:
+                break
+            self.wfile.write(block)
+            remaining -= len(block)
+
+    def log_message(self, format, *args):
+        pass
+
+@st.cache_resource
+def start_video_server():
+    """Serveur de streaming du processus, ou None s'il ne peut pas écouter (port déjà pris)."""
+    try:
+        server = ThreadingHTTPServer((VIDEO_STREAM_HOST, VIDEO_STREAM_PORT), VideoStreamHandler)
+    except OSError as exc:
+        print(f"[WARN] Serveur vidéo indisponible, lecture en mémoire : {exc}")
+        return None
+    threading.Thread(target=server.serve_forever, name="video-stream", daemon=True).start()
+    atexit.register(server.shutdown)
+    return server
+
+def video_source(file_id):
+    """Source de st.video pour une vidéo de la classe courante (None si elle n'en fait pas partie)."""
+    if file_id not in {str(video["_id"]) for video in load_videos()}:
+        return None
+    if VIDEO_STREAM_BASE_URL and start_video_server() is not None:
+        return VIDEO_STREAM_BASE_URL + signed_video_path(file_id)
+    return read_video(file_id)
+
 # Chargement initial des données
-if "students" not in st.session_state:
-    st.session_state["students"] = load_data()
+start_ledger_compaction()
+if METRICS_ENABLED and METRICS_PORT:
+    start_metrics_server()
+if "class_id" not in st.session_state:
+    st.session_state["class_id"] = None
+refresh_students()
 if "role" not in st.session_state:
     st.session_state["role"] = None
 if "user" not in st.session_state:
     st.session_state["user"] = None
+if "user_id" not in st.session_state:
+    st.session_state["user_id"] = None
 if "accepted_rules" not in st.session_state:
     st.session_state["accepted_rules"] = False
 
@@ -73,12 +1393,16 @@ if st.session_state["role"] is None:
             else:
                 st.error("Code incorrect.")
     else:
+        classes = load_classes()
+        if classes:
+            st.session_state["class_id"] = st.selectbox("Choisissez votre classe", classes)
+            refresh_students()
         if st.session_state["students"].empty:
             st.warning("Aucun élève n'est enregistré. Veuillez contacter votre enseignant.")
         else:
             student_name = st.selectbox("Choisissez votre nom", st.session_state["students"]["Nom"])
-            student_row = st.session_state["students"].loc[st.session_state["students"]["Nom"] == student_name].iloc[0]
-            if student_row["StudentCode"] == "":
+            student_id = student_id_for(student_name)
+            if not student_has_code(student_id):
                 st.info("Première connexion : veuillez créer un code d'accès.")
                 new_code = st.text_input("Créez un code d'accès (min. 4 caractères)", type="password", key="new_student_code")
                 new_code_confirm = st.text_input("Confirmez votre code", type="password", key="new_student_code_confirm")
@@ -88,21 +1412,22 @@ if st.session_state["role"] is None:
                     elif len(new_code) < 4:
                         st.error("Le code doit contenir au moins 4 caractères.")
                     else:
-                        idx = st.session_state["students"].index[st.session_state["students"]["Nom"] == student_name][0]
-                        st.session_state["students"].at[idx, "StudentCode"] = new_code
-                        save_data(st.session_state["students"])
+                        set_student_code(student_id, new_code)
                         st.session_state["role"] = "student"
                         st.session_state["user"] = student_name
+                        st.session_state["user_id"] = student_id
                         st.success(f"Accès élève autorisé pour {student_name}.")
             else:
                 code_entered = st.text_input("Entrez votre code d'accès", type="password", key="existing_student_code")
                 if st.button("Se connecter comme élève", key="student_conn"):
-                    if code_entered != student_row["StudentCode"]:
+                    if not check_student_code(student_id, code_entered):
                         st.error("Code incorrect.")
                     else:
                         st.session_state["role"] = "student"
                         st.session_state["user"] = student_name
+                        st.session_state["user_id"] = student_id
                         st.success(f"Accès élève autorisé pour {student_name}.")
+    end_rerun("Connexion")
     st.stop()
 
 # Bloc d'acceptation des règles
@@ -168,17 +1493,40 @@ if not st.session_state["accepted_rules"]:
     """)
     if st.button("Je confirme avoir lu les règles et m'engager à les respecter", key="accept_rules"):
         st.session_state["accepted_rules"] = True
+    end_rerun("Règles")
     st.stop()
 
 
 
+# Choix de la classe (l'élève reste dans la classe choisie à la connexion)
+def _create_class():
+    new_class = st.session_state["new_class_name"].strip()
+    if new_class:
+        st.session_state["class_id"] = new_class
+        st.session_state["new_class_name"] = ""
+
+if st.session_state["role"] == "teacher":
+    classes = load_classes()
+    if st.session_state["class_id"] is None:
+        st.session_state["class_id"] = classes[0] if classes else DEFAULT_CLASS
+    st.sidebar.selectbox("Classe", sorted(set(classes) | {st.session_state["class_id"]}), key="class_id")
+    st.sidebar.text_input("Nouvelle classe", key="new_class_name")
+    st.sidebar.button("Créer la classe", on_click=_create_class)
+    refresh_students()
+else:
+    st.sidebar.markdown(f"**Classe :** {st.session_state['class_id']}")
+
 # Pages disponibles
 if st.session_state["role"] == "teacher":
     pages = ["Accueil", "Ajouter Élève", "Tableau de progression", "Attribution de niveaux", "Hall of Fame", "Leaderboard", "Vidéo", "Fiche Élève"]
+    if METRICS_ENABLED:
+        pages.append("Diagnostics")
 else:
     pages = ["Accueil", "Tableau de progression", "Hall of Fame", "Leaderboard", "Vidéo", "Fiche Élève"]
 
 choice = st.sidebar.radio("Navigation", pages)
+# Rempli en fin de script, une fois les écritures de la page mises en file
+pending_caption = st.sidebar.empty()
 
 # PAGE ACCUEIL
 if choice == "Accueil":
@@ -186,7 +1534,10 @@ if choice == "Accueil":
     st.write("Utilisez le menu à gauche pour naviguer entre les sections.")
     st.markdown(f"**Mode d'accès :** {st.session_state['role'].capitalize()} ({st.session_state['user']})")
     if st.session_state["role"] == "teacher":
-        st.download_button("Télécharger le fichier CSV", data=st.session_state["students"].to_csv(index=False), file_name="students_data.csv", mime="text/csv")
+        if st.button("Préparer l'export CSV", key="prepare_export"):
+            st.session_state["export_requested"] = True
+        if st.session_state.get("export_requested"):
+            st.download_button("Télécharger le fichier CSV", data=export_students_csv(), file_name=f"students_data_{st.session_state['class_id']}.csv", mime="text/csv")
 
 # AJOUTER ELEVE
 elif choice == "Ajouter Élève":
@@ -200,33 +1551,98 @@ elif choice == "Ajouter Élève":
             points_comp = niveau * 5
             st.write(f"**Points de Compétence disponibles :** {points_comp}")
             submit_eleve = st.form_submit_button("Ajouter l'élève")
-        if submit_eleve and nom:
+        if submit_eleve and nom and student_id_for(nom) is not None:
+            st.error(f"Un élève nommé {nom} existe déjà.")
+        elif submit_eleve and nom:
             new_data = pd.DataFrame({
                 "Nom": [nom],
                 "Niveau": [niveau],
                 "Points de Compétence": [points_comp],
                 "Rôles": ["Apprenti(e)"],
                 "Pouvoirs": [""],
-                "StudentCode": [""],
-            })
-            st.session_state["students"] = pd.concat([st.session_state["students"], new_data], ignore_index=True)
-            for col in ["Niveau", "Points de Compétence"]:
-                st.session_state["students"][col] = pd.to_numeric(st.session_state["students"][col], errors="coerce").fillna(0).astype(int)
-            save_data(st.session_state["students"])
+            }, index=pd.Index([new_student_id()], name="StudentId"))
+            # Seule la nouvelle ligne est comparée et écrite
+            save_data(new_data.astype({"Niveau": int, "Points de Compétence": int}), before=new_data.iloc[0:0])
             st.success(f"✅ {nom} ajouté avec niveau {niveau}.")
 
+        st.subheader("📥 Import d'une liste d'élèves")
+        st.caption("Fichier CSV ou Excel avec une colonne « Nom » et, au choix, « Niveau », « Points de Compétence », « Rôles », « Pouvoirs ».")
+        roster_file = st.file_uploader("Liste d'élèves", type=["csv", "xlsx"], key="roster_import")
+        if roster_file is not None and st.button("Importer les élèves", key="import_students"):
+            try:
+                valid, rejected = validate_roster(read_roster_file(roster_file), st.session_state["students"]["Nom"])
+            except ValueError as exc:
+                st.error(str(exc))
+            else:
+                progress = st.progress(0.0, text="Import en cours…")
+                inserted = import_students(valid, lambda done, total: progress.progress(done / total, text=f"{done} / {total} élèves importés"))
+                st.success(f"✅ {inserted} élève(s) importé(s).")
+                if not rejected.empty:
+                    st.warning(f"{len(rejected)} ligne(s) ignorée(s) :")
+                    st.dataframe(rejected, hide_index=True)
+
 # TABLEAU DE PROGRESSION
 elif choice == "Tableau de progression":
     st.header("📊 Tableau de progression")
     if st.session_state["role"] == "teacher":
-        df = st.data_editor(st.session_state["students"], use_container_width=True)
-        if st.button("Enregistrer modifications"):
-            st.session_state["students"] = df
-            save_data(df)
+        col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
+        with col1:
+            search = st.text_input("Rechercher un nom", key="progress_search").strip()
+        with col2:
+            level_min = st.number_input("Niveau min", min_value=0, value=None, step=1, key="progress_level_min")
+        with col3:
+            level_max = st.number_input("Niveau max", min_value=0, value=None, step=1, key="progress_level_max")
+        with col4:
+            page_size = st.selectbox("Par page", PAGE_SIZES, key="progress_page_size")
+        total = count_progress_rows(search, level_min, level_max)
+        page_count = max(1, -(-total // page_size))
+        page = st.number_input(f"Page (sur {page_count})", min_value=1, max_value=page_count, value=1, step=1, key="progress_page")
+        page_df = load_progress_page(search, level_min, level_max, page, page_size)
+        st.caption(f"{total} élève(s) correspondant(s)")
+        # La clé ne dépend que de la page affichée (et des enregistrements de cette session) :
+        # une écriture faite ailleurs ne réinitialise pas la saisie en cours
+        generation = st.session_state.setdefault("progress_editor_generation", 0)
+        editor_key = f"progress_editor_{current_class()}_{search}_{level_min}_{level_max}_{page}_{page_size}_{generation}"
+        base_key = f"{editor_key}_base"
+        # Les lignes sur lesquelles porte la saisie restent figées tant qu'elle n'est pas enregistrée
+        if base_key not in st.session_state or not any((st.session_state.get(editor_key) or {}).values()):
+            st.session_state[base_key] = page_df
+        base_df = st.session_state[base_key]
+        if not base_df.equals(page_df):
+            st.info("Des élèves de cette page ont été modifiés ailleurs depuis le début de votre saisie.")
+        # Index par position pour l'éditeur : apply_editor_changes fait la correspondance avec les StudentId
+        st.data_editor(base_df.reset_index(drop=True), use_container_width=True, hide_index=True, num_rows="dynamic", key=editor_key)
+        col_save, col_reload = st.columns(2)
+        with col_save:
+            save_clicked = st.button("Enregistrer modifications")
+        with col_reload:
+            if st.button("Annuler et recharger la page"):
+                st.session_state["progress_editor_generation"] += 1
+                st.rerun()
+        if save_clicked:
+            try:
+                after = apply_editor_changes(base_df, st.session_state[editor_key])
+            except ValueError as exc:
+                st.error(str(exc))
+                after = None
+            if after is not None:
+                others = st.session_state["students"]["Nom"].drop(index=base_df.index, errors="ignore")
+                conflicts = editor_conflicts(base_df, after, current_students(base_df.index))
+                if after["Nom"].duplicated().any() or after["Nom"].isin(others).any():
+                    st.error("Chaque élève doit avoir un nom unique.")
+                elif conflicts:
+                    st.error(
+                        "Modifications non enregistrées : "
+                        + ", ".join(base_df.loc[conflicts, "Nom"])
+                        + " a/ont été modifié(s) ailleurs depuis le début de votre saisie. Annulez et rechargez la page."
+                    )
+                else:
+                    save_data(after, before=base_df)
+                    st.session_state["progress_editor_generation"] += 1
     else:
-        student = st.session_state["user"]
-        df = st.session_state["students"][st.session_state["students"]["Nom"] == student]
-        st.data_editor(df, use_container_width=True)
+        students = st.session_state["students"]
+        df = students[students.index == st.session_state["user_id"]]
+        st.data_editor(df, use_container_width=True, hide_index=True)
 
 # ATTRIBUTION DE NIVEAUX
 elif choice == "Attribution de niveaux":
@@ -234,22 +1650,33 @@ elif choice == "Attribution de niveaux":
         st.error("Accès réservé aux enseignants.")
     else:
         st.header("🏷️ Attribution de niveaux")
+        students = st.session_state["students"]
+        role_filter = st.multiselect("Filtrer par rôle", item_names(students, "Rôles"))
+        if role_filter:
+            students = students[students_with_item(students, "Rôles", role_filter)]
         with st.form("assign_form"):
-            selected = st.multiselect("Sélectionnez élèves", st.session_state["students"]["Nom"].tolist())
+            selected = st.multiselect("Sélectionnez élèves", students["Nom"].tolist())
             levels = st.number_input("Niveaux à ajouter", min_value=1, step=1)
             submit = st.form_submit_button("Ajouter")
         if submit:
-            for nom in selected:
-                idx = st.session_state["students"].index[st.session_state["students"]["Nom"] == nom][0]
-                st.session_state["students"].at[idx, "Niveau"] += levels
-                st.session_state["students"].at[idx, "Points de Compétence"] += levels * 5
-            save_data(st.session_state["students"])
+            grant_levels([student_id_for(nom) for nom in selected], int(levels))
             st.success("Attributions appliquées.")
+        with st.expander("📈 Gains depuis une date"):
+            since = st.date_input("Depuis le", value=datetime.now().date() - timedelta(days=90))
+            gains = load_gains(st.session_state["students"].index, datetime.combine(since, datetime.min.time(), tzinfo=timezone.utc))
+            if gains:
+                names = st.session_state["students"]["Nom"]
+                st.dataframe(pd.DataFrame([
+                    {"Nom": names.get(gain["_id"], gain["_id"]), "Niveaux gagnés": gain["Niveau"], "Points gagnés": gain["Points_de_Competence"]}
+                    for gain in gains
+                ]), hide_index=True)
+            else:
+                st.info("Aucun gain enregistré sur cette période.")
 
 # HALL OF FAME
 elif choice == "Hall of Fame":
     st.header("🏆 Hall of Fame")
-    hof_data = load_hof()
+    hof_data = load_hof(st.session_state["class_id"])
     st.session_state["hall_of_fame"] = hof_data
     if st.session_state["role"] == "teacher":
         st.subheader("Modifier le Hall of Fame")
@@ -268,7 +1695,7 @@ elif choice == "Hall of Fame":
                 new_entries.append({"name": name, "achievement": achievement})
             if st.form_submit_button("Enregistrer le Hall of Fame"):
                 st.session_state["hall_of_fame"] = new_entries
-                save_hof(new_entries)
+                save_hof(new_entries, st.session_state["class_id"])
                 st.success("Hall of Fame mis à jour.")
     st.subheader("Les Exploits")
     for entry in st.session_state["hall_of_fame"]:
@@ -280,36 +1707,40 @@ elif choice == "Hall of Fame":
 # LEADERBOARD
 elif choice == "Leaderboard":
     st.header("🏆 Leaderboard")
-    leaderboard = st.session_state["students"].sort_values("Points de Compétence", ascending=False)
     st.subheader("Le top ten")
-    top10 = leaderboard.head(10)
-    for rank, (_, row) in enumerate(top10.iterrows(), start=1):
-        st.markdown(
-            f"**{rank}. {row['Nom']}** - Niveau: {row['Niveau']} - Points: {row['Points de Compétence']}<br>"
-            f"**Rôle:** {row['Rôles']} | **Pouvoirs:** {row['Pouvoirs']} :trophy:",
-            unsafe_allow_html=True
-        )
+    st.markdown(
+        "\n\n".join(
+            f"**{rank}. {row.get('Nom')}** - Niveau: {row.get('Niveau')} - Points: {row.get('Points_de_Competence')}<br>"
+            f"**Rôle:** {row.get('Rôles')} | **Pouvoirs:** {row.get('Pouvoirs')} :trophy:"
+            for rank, row in enumerate(load_leaderboard(10), start=1)
+        ),
+        unsafe_allow_html=True
+    )
 
 # VIDEO
 elif choice == "Vidéo":
     st.header("📹 Vidéo")
-    video_filename = "uploaded_video.mp4"
     if st.session_state["role"] == "teacher":
-        st.subheader("Gérer la vidéo")
+        st.subheader("Gérer les vidéos")
         uploaded_file = st.file_uploader("Uploader une vidéo (MP4)", type=["mp4"])
-        col1, col2 = st.columns(2)
-        with col1:
-            if uploaded_file is not None:
-                with open(video_filename, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+        # Le fichier reste dans l'uploader entre deux réexécutions : on ne l'enregistre qu'une fois
+        if uploaded_file is not None and st.session_state.get("stored_video_upload") != uploaded_file.file_id:
+            _, created = store_video(get_video_bucket(), uploaded_file.name, uploaded_file, st.session_state["class_id"])
+            st.session_state["stored_video_upload"] = uploaded_file.file_id
+            if created:
                 st.success("Vidéo téléchargée avec succès!")
-        with col2:
-            if os.path.exists(video_filename):
-                if st.button("Retirer la vidéo"):
-                    os.remove(video_filename)
-                    st.success("Vidéo retirée avec succès!")
-    if os.path.exists(video_filename):
-        st.video(video_filename)
+            else:
+                st.info("Cette vidéo est déjà enregistrée.")
+    videos = load_videos()
+    if videos:
+        labels = {str(video["_id"]): f"{video['filename']} ({video['uploadDate']:%d.%m.%Y})" for video in videos}
+        selected_video = st.selectbox("Choisir une vidéo", list(labels), format_func=labels.get)
+        source = video_source(selected_video)
+        if source is not None:
+            st.video(source)
+        if st.session_state["role"] == "teacher" and st.button("Retirer la vidéo"):
+            delete_video(selected_video, st.session_state["class_id"])
+            st.success("Vidéo retirée avec succès!")
     else:
         st.info("Aucune vidéo n'a encore été téléchargée.")
 
@@ -317,12 +1748,19 @@ elif choice == "Vidéo":
 elif choice == "Fiche Élève":
     st.header("🔍 Fiche de l'élève")
     if st.session_state["role"] == "teacher":
-        selected_student = st.selectbox("Choisir un élève", st.session_state["students"]["Nom"])
+        student_id = student_id_for(st.selectbox("Choisir un élève", st.session_state["students"]["Nom"]))
     else:
-        selected_student = st.session_state["user"]
-        st.info(f"Vous êtes connecté(e) en tant que {selected_student}.")
-    if selected_student:
-        student_data = st.session_state["students"].loc[st.session_state["students"]["Nom"] == selected_student].iloc[0]
+        # Par identifiant : l'enseignant a pu renommer l'élève depuis sa connexion
+        student_id = st.session_state["user_id"]
+    if student_id is not None and student_id not in st.session_state["students"].index:
+        st.error("Cet élève n'est plus inscrit dans la classe.")
+        student_id = None
+    if student_id is not None:
+        student_data = get_student(student_id)
+        selected_student = student_data["Nom"]
+        if st.session_state["role"] != "teacher":
+            st.session_state["user"] = selected_student
+            st.info(f"Vous êtes connecté(e) en tant que {selected_student}.")
         st.subheader(f"📌 Fiche de {selected_student}")
         col1, col2 = st.columns(2)
         with col1:
@@ -330,7 +1768,12 @@ elif choice == "Fiche Élève":
             st.write(f"**Points de Compétence :** {student_data['Points de Compétence']}")
             if st.button("Fêter ma progression"):
                 st.balloons()
-        onglets = st.tabs(["🛒 Boutique des Pouvoirs", "🏅 Boutique des Rôles"])
+        if st.session_state["role"] == "teacher":
+            with col2:
+                if st.button("Réinitialiser le code d'accès"):
+                    set_student_code(student_data.name, "")
+                    st.success(f"{selected_student} créera un nouveau code à sa prochaine connexion.")
+        onglets = st.tabs(["🛒 Boutique des Pouvoirs", "🏅 Boutique des Rôles", "📜 Historique"])
         with onglets[0]:
             store_items = {
                 "Le malin / la maligne": 40,
@@ -343,17 +1786,13 @@ elif choice == "Fiche Élève":
             cost = store_items[selected_item]
             st.info(f"💰 Coût: {cost} niveaux")
             if st.button("Acheter ce pouvoir", key="acheter_pouvoir"):
-                if int(student_data["Niveau"]) >= cost:
-                    current_level = int(student_data["Niveau"])
-                    new_level = current_level - cost
-                    st.session_state["students"].loc[st.session_state["students"]["Nom"] == selected_student, "Niveau"] = new_level
-                    anciens_pouvoirs = str(student_data["Pouvoirs"]) if pd.notna(student_data["Pouvoirs"]) else ""
-                    nouveaux_pouvoirs = anciens_pouvoirs + ", " + selected_item if anciens_pouvoirs else selected_item
-                    st.session_state["students"].loc[st.session_state["students"]["Nom"] == selected_student, "Pouvoirs"] = nouveaux_pouvoirs
-                    save_data(st.session_state["students"])
+                result = purchase(student_data.name, "Niveau", cost, "Pouvoirs", selected_item)
+                if result == "ok":
                     st.success(f"🛍️ {selected_student} a acheté '{selected_item}'.")
-                else:
+                elif result == "insuffisant":
                     st.error("❌ Niveaux insuffisants !")
+                else:
+                    st.error("❌ Achat impossible pour le moment, réessayez dans un instant.")
         with onglets[1]:
             roles_store = {
                 "Testeur.euse": 200,
@@ -373,14 +1812,58 @@ elif choice == "Fiche Élève":
             role_cost = roles_store[selected_role]
             st.info(f"💰 Coût: {role_cost} points de compétence")
             if st.button("Acquérir ce rôle", key="acheter_role"):
-                if int(student_data["Points de Compétence"]) >= role_cost:
-                    current_points = int(student_data["Points de Compétence"])
-                    new_points = current_points - role_cost
-                    st.session_state["students"].loc[st.session_state["students"]["Nom"] == selected_student, "Points de Compétence"] = new_points
-                    anciens_roles = str(student_data["Rôles"]) if pd.notna(student_data["Rôles"]) else ""
-                    nouveaux_roles = anciens_roles + ", " + selected_role if anciens_roles else selected_role
-                    st.session_state["students"].loc[st.session_state["students"]["Nom"] == selected_student, "Rôles"] = nouveaux_roles
-                    save_data(st.session_state["students"])
+                result = purchase(student_data.name, "Points_de_Competence", role_cost, "Rôles", selected_role)
+                if result == "ok":
                     st.success(f"🏅 {selected_student} a acquis le rôle '{selected_role}'.")
-                else:
+                elif result == "insuffisant":
                     st.error("❌ Points de compétence insuffisants !")
+                else:
+                    st.error("❌ Achat impossible pour le moment, réessayez dans un instant.")
+        with onglets[2]:
+            if st.session_state["role"] == "teacher" and st.toggle("Vérifier les soldes avec le journal"):
+                drift = ledger_drift(student_data.name)
+                if drift is None:
+                    st.info("Écritures de l'élève encore en attente d'envoi : vérification impossible pour le moment.")
+                elif not drift:
+                    st.success("Le journal et la fiche concordent.")
+                else:
+                    st.warning(f"Écart entre la fiche et le journal (fiche − journal) : {drift}")
+                    if st.button("Aligner le journal sur la fiche"):
+                        reconcile_student(student_data.name, drift)
+                        st.success("Événement de rapprochement enregistré.")
+            history = load_history(student_data.name)
+            if history:
+                st.dataframe(pd.DataFrame(history), hide_index=True)
+            else:
+                st.info("Aucun événement enregistré.")
+
+# DIAGNOSTICS
+elif choice == "Diagnostics":
+    if st.session_state["role"] != "teacher":
+        st.error("Accès réservé aux enseignants.")
+    else:
+        st.header("🩺 Diagnostics")
+        reruns, commands = metrics_snapshot()
+        st.caption(f"{len(reruns)} dernières réexécutions et {len(commands)} dernières commandes MongoDB, tous utilisateurs confondus.")
+        if not METRICS_COUNT_BYTES:
+            st.caption("Octets non comptés (secret METRICS_COUNT_BYTES pour les activer).")
+        st.subheader("Réexécutions par page")
+        st.dataframe(rerun_stats(reruns))
+        st.subheader("Fonctions d'accès aux données")
+        st.dataframe(span_stats(reruns))
+        st.subheader("Requêtes les plus lentes")
+        slowest = sorted(commands, key=lambda command: command["ms"], reverse=True)[:20]
+        if slowest:
+            st.dataframe(pd.DataFrame(slowest)[["page", "command", "collection", "ms", "bytes", "failed"]].rename(columns={
+                "page": "Page", "command": "Commande", "collection": "Collection", "ms": "Durée (ms)", "bytes": "Octets", "failed": "Échec",
+            }), hide_index=True)
+        else:
+            st.info("Aucune commande MongoDB enregistrée.")
+        st.download_button("Exporter au format Prometheus", data=prometheus_metrics(), file_name="suivi_eps_metrics.prom", mime="text/plain")
+        if METRICS_PORT:
+            st.caption(f"Les mêmes mesures sont servies sur le port {METRICS_PORT} (/metrics).")
+
+if WRITE_BEHIND:
+    pending_caption.caption(f"⏳ Écritures en attente : {pending_writes()}")
+
+end_rerun(choice)
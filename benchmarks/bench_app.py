@@ -0,0 +1,466 @@
+"""Banc d'essai de app.py : scénarios de charge rejoués avec l'AppTest de Streamlit.
+
+L'application tourne dans ce processus, avec des st.secrets factices. Elle utilise
+soit une base en mémoire (mongomock, par défaut), soit un mongod local
+(--mongo-uri). Les scénarios sont rejoués sur un roster synthétique :
+connexion simultanée des élèves, attribution de niveaux à toute la classe, achats
+en boutique et consultation du leaderboard. Pour chaque scénario, le banc rapporte
+la latence des réexécutions, le nombre d'opérations MongoDB, les octets écrits et
+le pic de mémoire (tracemalloc). Chaque action est vérifiée (message affiché et
+état de la base) : une action qui échoue interrompt le banc au lieu de fausser
+les mesures.
+
+Exemples :
+    python benchmarks/bench_app.py --students 1000 --sessions 30
+    python benchmarks/bench_app.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_app.py --baseline benchmarks/baseline.json --tolerance 0.25
+
+Avec --baseline, le script se termine avec le code 1 si une mesure dépasse la
+référence au-delà de la tolérance. Les latences dépendent de la machine : la
+référence doit être produite sur la machine qui la compare, avec les mêmes
+options : tracemalloc ralentit nettement les réexécutions, --no-memory le désactive
+pour ne mesurer que les latences.
+
+Installation : pip install -r benchmarks/requirements.txt (dépendances de app.py,
+AppTest de streamlit >= 1.28, et pymongo < 4.9, seule version prise en charge par
+mongomock). mongomock diffère aussi de MongoDB sur un point :
+find_one_and_update(..., return_document=ReturnDocument.AFTER) y renvoie None dès
+que le filtre ne correspond plus au document mis à jour (un filtre sur le solde
+qui vient d'être débité, par exemple). purchase() demande le document d'avant la
+mise à jour et n'y est pas sensible ; le banc vérifie de toute façon le solde en
+base après chaque achat.
+Attention : la base "SuiviEPS" du serveur désigné par --mongo-uri est vidée si
+l'option --reset est donnée ; sans elle, le banc refuse une base non vide.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+from pathlib import Path
+
+import pymongo
+from bson import encode as encode_bson
+from pymongo import monitoring
+
+APP_PATH = Path(__file__).resolve().parent.parent / "app.py"
+DATABASE = "SuiviEPS"
+CLASS_ID = "Classe principale"
+ACCESS_CODE = "bench"
+STUDENT_CODE = "1234"
+SCENARIOS = ["login_storm", "bulk_attribution", "purchases", "leaderboard_views"]
+# Mesures comparées à la référence, avec un écart absolu toléré en plus de la tolérance relative
+REGRESSION_SLACK = {"p95_ms": 5.0, "ops": 0, "bytes_written": 1024, "peak_mb": 1.0}
+WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+# Premier pouvoir de la boutique, sélectionné par défaut
+POWER_ITEM = "Le malin / la maligne"
+POWER_COST = 40
+# Délai laissé à l'écriture différée avant de vérifier la base (s)
+WRITE_BEHIND_SETTLE = 10
+
+
+# Compteur d'opérations MongoDB
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = 0
+        self.bytes_written = 0
+        # Les lectures de vérification du banc ne comptent pas
+        self.local = threading.local()
+
+    def add(self, ops=1, written=0):
+        if getattr(self.local, "paused", False):
+            return
+        with self.lock:
+            self.ops += ops
+            self.bytes_written += written
+
+    def reset(self):
+        with self.lock:
+            self.ops, self.bytes_written = 0, 0
+
+    @contextlib.contextmanager
+    def paused(self):
+        self.local.paused = True
+        try:
+            yield
+        finally:
+            self.local.paused = False
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Écouteur global pymongo (mode mongod) : une opération par commande."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def started(self, event):
+        written = len(encode_bson(event.command)) if event.command_name in WRITE_COMMANDS else 0
+        self.recorder.add(written=written)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _payload_size(*parts):
+    return len(encode_bson({str(i): part for i, part in enumerate(parts) if part is not None}))
+
+
+def _written_bytes(name, args, kwargs):
+    if name == "insert_one":
+        return _payload_size(args[0])
+    if name == "insert_many":
+        return sum(_payload_size(doc) for doc in args[0])
+    if name == "bulk_write":
+        return sum(_payload_size(getattr(op, "_filter", None), getattr(op, "_doc", None)) for op in args[0])
+    if name in ("update_one", "update_many", "replace_one", "find_one_and_update", "find_one_and_replace"):
+        return _payload_size(args[0], args[1] if len(args) > 1 else kwargs.get("update", kwargs.get("replacement")))
+    if name in ("delete_one", "delete_many", "find_one_and_delete"):
+        return _payload_size(args[0] if args else kwargs.get("filter"))
+    return 0
+
+
+def instrument_mongomock(recorder):
+    """Compte les appels de mongomock : mongomock ne publie pas d'événements de commande.
+
+    Seul l'appel le plus externe compte (find_one appelle find, par exemple).
+    """
+    import mongomock
+
+    depth = threading.local()
+    names = [
+        "find", "find_one", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+        "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one",
+        "delete_many", "bulk_write", "count_documents", "estimated_document_count", "distinct",
+        "aggregate", "create_index",
+    ]
+    for name in names:
+        original = getattr(mongomock.collection.Collection, name)
+
+        def wrapper(self, *args, _original=original, _name=name, **kwargs):
+            outer = not getattr(depth, "value", 0)
+            depth.value = getattr(depth, "value", 0) + 1
+            try:
+                if outer:
+                    recorder.add(written=_written_bytes(_name, args, kwargs))
+                return _original(self, *args, **kwargs)
+            finally:
+                depth.value -= 1
+
+        setattr(mongomock.collection.Collection, name, functools.wraps(original)(wrapper))
+
+
+def connect(args, recorder):
+    """Client MongoDB du banc ; l'application reçoit le même via pymongo.MongoClient."""
+    if args.mongo_uri:
+        monitoring.register(CommandRecorder(recorder))
+        return pymongo.MongoClient(args.mongo_uri)
+    import mongomock
+    import mongomock.gridfs
+
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+    # GridFSBucket lit client.options.timeout, absent de mongomock
+    client.options = types.SimpleNamespace(timeout=None)
+
+    class SharedClient(mongomock.MongoClient):
+        def __new__(cls, *a, **k):
+            return client
+
+    pymongo.MongoClient = SharedClient
+    instrument_mongomock(recorder)
+    return client
+
+
+def seed_roster(db, size, seed):
+    """Roster synthétique : niveaux tirés au hasard, codes d'accès déjà créés."""
+    rng = random.Random(seed)
+    names = [f"Élève {i:04d}" for i in range(size)]
+    students = []
+    for name in names:
+        niveau = rng.randint(0, 400)
+        students.append({
+            "StudentId": uuid.uuid4().hex, "class_id": CLASS_ID, "Nom": name,
+            "Niveau": niveau, "Points_de_Competence": niveau * 5 + rng.randint(0, 500),
+            "Rôles": ["Apprenti(e)"], "Pouvoirs": [], "StudentCode": STUDENT_CODE,
+        })
+    db.students.insert_many(students, ordered=False)
+    return names
+
+
+# Pilotage de l'application
+class Bench:
+    def __init__(self, args, recorder, db, names):
+        from streamlit.testing.v1 import AppTest
+
+        self.AppTest = AppTest
+        self.args = args
+        self.recorder = recorder
+        self.db = db
+        self.names = names
+        self.latencies = []
+        self.outcomes = {"ok": 0, "refused": 0}
+        self.teacher = None
+        self.students = {}
+
+    def new_app(self):
+        at = self.AppTest.from_file(str(APP_PATH), default_timeout=self.args.timeout)
+        at.secrets["MONGO_URI"] = self.args.mongo_uri or "mongodb://bench"
+        at.secrets["ACCESS_CODE"] = ACCESS_CODE
+        at.secrets["LEDGER_COMPACTION_INTERVAL"] = 24 * 3600
+        at.secrets["WRITE_BEHIND"] = "true" if self.args.write_behind else "false"
+        return at
+
+    def step(self, target):
+        """Une réexécution chronométrée ; `target` est une AppTest ou un widget modifié."""
+        start = time.perf_counter()
+        at = target.run()
+        self.latencies.append((time.perf_counter() - start) * 1000)
+        if at.exception:
+            raise RuntimeError(f"Exception dans app.py : {at.exception[0].value}")
+        return at
+
+    @staticmethod
+    def widget(elements, label):
+        return next(element for element in elements if element.label == label)
+
+    @staticmethod
+    def shown(elements, text):
+        return any(text in element.value for element in elements)
+
+    def expect(self, condition, message):
+        """Vérifie l'état de la base, en laissant à l'écriture différée le temps de l'envoyer."""
+        deadline = time.monotonic() + (WRITE_BEHIND_SETTLE if self.args.write_behind else 0)
+        with self.recorder.paused():
+            while not condition():
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(message)
+                time.sleep(0.1)
+
+    def student(self, name):
+        with self.recorder.paused():
+            return self.db.students.find_one({"class_id": CLASS_ID, "Nom": name})
+
+    def total_levels(self):
+        with self.recorder.paused():
+            return sum(doc["Niveau"] for doc in self.db.students.find({"class_id": CLASS_ID}, {"Niveau": 1}))
+
+    def navigate(self, at, page):
+        at = self.step(self.widget(at.sidebar.radio, "Navigation").set_value(page))
+        if self.widget(at.sidebar.radio, "Navigation").value != page:
+            raise RuntimeError(f"Page « {page} » non affichée")
+        return at
+
+    def login_teacher(self):
+        at = self.step(self.new_app())
+        self.widget(at.text_input, "Entrez le code d'accès enseignant :").input(ACCESS_CODE)
+        at = self.step(at.button(key="teacher_conn").click())
+        if at.session_state["role"] != "teacher":
+            raise RuntimeError("Connexion enseignant refusée")
+        # Le rôle est enregistré pendant la réexécution : les règles s'affichent à la suivante
+        at = self.step(at)
+        at = self.step(at.button(key="accept_rules").click())
+        return self.step(at)
+
+    def login_student(self, name):
+        at = self.step(self.new_app())
+        at = self.step(self.widget(at.radio, "Choisissez votre rôle").set_value("Élève"))
+        at = self.step(self.widget(at.selectbox, "Choisissez votre nom").set_value(name))
+        at.text_input(key="existing_student_code").input(STUDENT_CODE)
+        at = self.step(at.button(key="student_conn").click())
+        if at.session_state["role"] != "student":
+            raise RuntimeError(f"Connexion refusée pour {name}")
+        at = self.step(at)
+        at = self.step(at.button(key="accept_rules").click())
+        return self.step(at)
+
+    def student_sessions(self):
+        if not self.students:
+            for name in self.names[:self.args.sessions]:
+                self.students[name] = self.login_student(name)
+        return self.students
+
+    def teacher_session(self):
+        if self.teacher is None:
+            self.teacher = self.login_teacher()
+        return self.teacher
+
+    # Scénarios
+    def login_storm(self):
+        # Toutes les sessions se connectent « en même temps » : aucune n'a encore navigué
+        self.students = {}
+        self.student_sessions()
+
+    def bulk_attribution(self):
+        at = self.navigate(self.teacher_session(), "Attribution de niveaux")
+        expected = self.total_levels()
+        for _ in range(self.args.repeat):
+            self.widget(at.multiselect, "Sélectionnez élèves").set_value(self.names)
+            self.widget(at.number_input, "Niveaux à ajouter").set_value(5)
+            at = self.step(self.widget(at.button, "Ajouter").click())
+            if not self.shown(at.success, "Attributions appliquées."):
+                raise RuntimeError("Attribution de niveaux non confirmée")
+            self.outcomes["ok"] += 1
+            expected += 5 * len(self.names)
+        self.expect(lambda: self.total_levels() == expected, f"Niveaux en base différents des attributions (attendu : {expected})")
+        self.teacher = at
+
+    def purchases(self):
+        for name, at in self.student_sessions().items():
+            at = self.navigate(at, "Fiche Élève")
+            if at.selectbox(key="pouvoirs").value != POWER_ITEM:
+                raise RuntimeError(f"Pouvoir sélectionné inattendu : {at.selectbox(key='pouvoirs').value}")
+            for _ in range(self.args.repeat):
+                before = self.student(name)
+                at = self.step(at.button(key="acheter_pouvoir").click())
+                if self.shown(at.success, f"a acheté '{POWER_ITEM}'"):
+                    expected = before["Niveau"] - POWER_COST
+                    self.outcomes["ok"] += 1
+                elif self.shown(at.error, "Niveaux insuffisants") and before["Niveau"] < POWER_COST:
+                    expected = before["Niveau"]
+                    self.outcomes["refused"] += 1
+                else:
+                    messages = [element.value for element in at.error]
+                    raise RuntimeError(f"Achat de {name} non confirmé (solde {before['Niveau']}) : {messages}")
+                self.expect(lambda: self.student(name)["Niveau"] == expected, f"Solde de {name} incorrect après l'achat (attendu : {expected})")
+            self.students[name] = at
+
+    def leaderboard_views(self):
+        sessions = list(self.student_sessions().items()) + [("Enseignant", self.teacher_session())]
+        for _ in range(self.args.repeat):
+            for name, at in sessions:
+                at = self.navigate(at, "Leaderboard" if at.sidebar.radio[0].value != "Leaderboard" else "Accueil")
+                if name in self.students:
+                    self.students[name] = at
+                else:
+                    self.teacher = at
+
+    def measure(self, scenario):
+        """Rejoue un scénario ; les sessions qu'il ouvre pour la première fois comptent dans ses mesures."""
+        self.latencies = []
+        self.outcomes = {"ok": 0, "refused": 0}
+        self.recorder.reset()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        getattr(self, scenario)()
+        if self.args.write_behind:
+            # Laisse le fil d'écriture différée vider sa file
+            time.sleep(2)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracing else None
+        latencies = sorted(self.latencies)
+        return {
+            "reruns": len(latencies),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2),
+            "max_ms": round(latencies[-1], 2),
+            "ops": self.recorder.ops,
+            "ops_per_rerun": round(self.recorder.ops / len(latencies), 2),
+            "bytes_written": self.recorder.bytes_written,
+            "peak_mb": round((peak - start_memory) / 1e6, 2) if tracing else None,
+            "seconds": round(elapsed, 2),
+            # Actions confirmées, et achats refusés faute de solde
+            "ok": self.outcomes["ok"],
+            "refused": self.outcomes["refused"],
+        }
+
+
+# Rapport et comparaison à la référence
+def print_report(results):
+    columns = ["reruns", "p50_ms", "p95_ms", "max_ms", "ops", "ops_per_rerun", "bytes_written", "peak_mb", "seconds", "ok", "refused"]
+    width = max(len(name) for name in results) + 2
+    print("scénario".ljust(width) + "".join(column.rjust(15) for column in columns))
+    for name, result in results.items():
+        print(name.ljust(width) + "".join(str(result[column]).rjust(15) for column in columns))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for scenario, result in results.items():
+        reference = baseline.get("results", {}).get(scenario)
+        if reference is None:
+            continue
+        for metric, slack in REGRESSION_SLACK.items():
+            if reference.get(metric) is None or result[metric] is None:
+                continue
+            limit = reference[metric] + max(reference[metric] * tolerance, slack)
+            if result[metric] > limit:
+                found.append(f"{scenario}.{metric} : {result[metric]} > {round(limit, 2)} (référence {reference[metric]})")
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--students", type=int, default=1000, help="taille du roster synthétique")
+    parser.add_argument("--sessions", type=int, default=30, help="nombre d'élèves connectés simultanément")
+    parser.add_argument("--repeat", type=int, default=3, help="répétitions de chaque action par session")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--mongo-uri", help="mongod local à utiliser à la place de mongomock")
+    parser.add_argument("--reset", action="store_true", help="vide la base SuiviEPS de --mongo-uri avant de commencer")
+    parser.add_argument("--write-behind", action="store_true", help="active l'écriture différée de l'application")
+    parser.add_argument("--no-memory", action="store_true", help="sans tracemalloc : latences plus fidèles, pas de pic de mémoire")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120, help="délai maximal d'une réexécution (s)")
+    parser.add_argument("--json", type=Path, help="écrit les résultats dans ce fichier")
+    parser.add_argument("--baseline", type=Path, help="référence à comparer aux résultats")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="dépassement relatif toléré par rapport à la référence")
+    parser.add_argument("--save-baseline", type=Path, help="enregistre les résultats comme nouvelle référence")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.no_memory:
+        tracemalloc.start()
+    recorder = Recorder()
+    client = connect(args, recorder)
+    db = client[DATABASE]
+    if args.mongo_uri and db.list_collection_names():
+        if not args.reset:
+            sys.exit(f"La base {DATABASE} de {args.mongo_uri} n'est pas vide (utiliser --reset pour la vider).")
+        client.drop_database(DATABASE)
+    names = seed_roster(db, args.students, args.seed)
+    bench = Bench(args, recorder, db, names)
+
+    results = {}
+    for scenario in args.scenarios:
+        results[scenario] = bench.measure(scenario)
+        print(f"[bench] {scenario} : {results[scenario]['reruns']} réexécutions en {results[scenario]['seconds']} s", file=sys.stderr)
+    print_report(results)
+
+    report = {
+        "params": {key: getattr(args, key) for key in ("students", "sessions", "repeat", "write_behind", "no_memory", "seed")},
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "results": results,
+    }
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("params") != report["params"] or baseline.get("backend") != report["backend"]:
+            print("[WARN] Paramètres différents de ceux de la référence : comparaison peu significative.", file=sys.stderr)
+        found = regressions(results, baseline, args.tolerance)
+        if found:
+            print("Régressions :\n" + "\n".join(f"  - {line}" for line in found))
+            return 1
+        print("Aucune régression par rapport à la référence.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())